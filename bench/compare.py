@@ -0,0 +1,66 @@
+import argparse
+import json
+import sys
+
+# usage: python -m bench.compare bench/results/base.json bench/results/new.json --threshold 0.10
+#
+# Matches runs by (transport, db mode, fast JSON, scenario) and exits with 1 when any of them got slower
+# (p95 up or requests per second down) by more than the threshold.
+
+
+def _runs(path):
+    with open(path) as file:
+        results = json.load(file)
+    runs = {}
+    for run in results["runs"]:
+        for scenario, result in run["scenarios"].items():
+            runs[(run["transport"], run["db_mode"], run["fast_json"], scenario)] = result
+    return results["meta"], runs
+
+
+def _change(old, new):
+    if not old or new is None:
+        return None
+    return (new - old) / old
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    baseline_meta, baseline = _runs(args.baseline)
+    candidate_meta, candidate = _runs(args.candidate)
+    if baseline_meta["scale"] != candidate_meta["scale"]:
+        print(f"warning: comparing scale {baseline_meta['scale']} with {candidate_meta['scale']}", file=sys.stderr)
+
+    regressions = []
+    print(f"{'configuration':40} {'rps':>18} {'p95 ms':>20} {'p99 ms':>20}")
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key], candidate[key]
+        rps = _change(old["rps"], new["rps"])
+        p95 = _change(old["latency_ms"]["p95"], new["latency_ms"]["p95"])
+        p99 = _change(old["latency_ms"]["p99"], new["latency_ms"]["p99"])
+        print(
+            f"{' '.join(key):40} {old['rps']:>8} {_percent(rps):>9} "
+            f"{old['latency_ms']['p95']:>10} {_percent(p95):>9} {old['latency_ms']['p99']:>10} {_percent(p99):>9}"
+        )
+        if (rps is not None and rps < -args.threshold) or (p95 is not None and p95 > args.threshold):
+            regressions.append(key)
+
+    for key in sorted(baseline.keys() ^ candidate.keys()):
+        print(f"{' '.join(key):40} only in {'baseline' if key in baseline else 'candidate'}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}", file=sys.stderr)
+        sys.exit(1)
+
+
+def _percent(change):
+    return "" if change is None else f"{change:+.1%}"
+
+
+if __name__ == "__main__":
+    main()
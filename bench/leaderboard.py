@@ -0,0 +1,89 @@
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from database import Base
+import leaderboard
+import models
+
+# usage: python -m bench.leaderboard --trees 1000 10000 100000 1000000
+#
+# Cost of one ranking update and of a top-k read as the number of ranked trees grows. With an O(log n)
+# structure the update time per operation grows with log n (a few hundred ns more per 10x trees), not with n.
+# --sql also times the GROUP BY ... ORDER BY SUM(close_meter) query the leaderboard replaces.
+
+
+def measure_updates(trees: int, updates: int, rng):
+    ranking = leaderboard.Ranking({tree_id: rng.randint(1, 1000) for tree_id in range(1, trees + 1)})
+    deltas = [(rng.randint(1, trees), rng.randint(-50, 50) or 1) for _ in range(updates)]
+    start = time.perf_counter()
+    for tree_id, delta in deltas:
+        ranking.add(tree_id, delta)
+    update_seconds = (time.perf_counter() - start) / updates
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        ranking.top(10)
+    top_seconds = (time.perf_counter() - start) / 1000
+    return update_seconds, top_seconds
+
+
+def measure_sql(trees: int, rng):
+    with tempfile.TemporaryDirectory() as directory:
+        bind = create_engine(f"sqlite:///{os.path.join(directory, 'kokoroiki.db')}")
+        Base.metadata.create_all(bind)
+        with bind.begin() as connection:
+            connection.execute(models.Closeness.__table__.insert(), [
+                {"tree_id": rng.randint(1, trees), "close_meter": rng.randint(1, 100)} for _ in range(trees * 5)
+            ])
+        with Session(bind) as session:
+            start = time.perf_counter()
+            ranking = leaderboard.Leaderboard._totals(session)
+            sorted(ranking.items(), key=lambda item: (-item[1], item[0]))[:10]
+            seconds = time.perf_counter() - start
+        bind.dispose()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Leaderboard update and top-k cost by number of trees")
+    parser.add_argument("--trees", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--updates", type=int, default=100_000)
+    parser.add_argument("--sql", action="store_true", help="also time the GROUP BY query (5 closeness rows per tree)")
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    structure = "SortedList" if leaderboard.SortedList is not None else "bisect list"
+    print(f"ranking structure: {structure}")
+    results = []
+    for trees in args.trees:
+        update_seconds, top_seconds = measure_updates(trees, args.updates, rng)
+        result = {
+            "trees": trees,
+            "update_us": round(update_seconds * 1e6, 3),
+            "update_us_per_log2_n": round(update_seconds * 1e6 / math.log2(trees), 4),
+            "top10_us": round(top_seconds * 1e6, 3),
+        }
+        line = (
+            f"{trees:>9} trees  update {result['update_us']:>7} us"
+            f"  ({result['update_us_per_log2_n']} us per log2 n)  top-10 {result['top10_us']:>6} us"
+        )
+        if args.sql:
+            result["group_by_ms"] = round(measure_sql(trees, rng) * 1000, 2)
+            line += f"  GROUP BY {result['group_by_ms']:>9} ms"
+        results.append(result)
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"structure": structure, "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
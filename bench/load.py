@@ -0,0 +1,75 @@
+import asyncio
+import math
+import random
+import statistics
+import time
+from collections import defaultdict
+from bench.scenarios import chooser
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values, fraction: float):
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def summarize(latencies, seconds: float):
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "rps": round(len(values) / seconds, 2) if seconds else None,
+        "latency_ms": {
+            "p50": _ms(percentile(values, 0.50)),
+            "p95": _ms(percentile(values, 0.95)),
+            "p99": _ms(percentile(values, 0.99)),
+            "mean": _ms(statistics.fmean(values)) if values else None,
+            "max": _ms(values[-1]) if values else None,
+        },
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+# Send `requests` requests of a scenario through an httpx.AsyncClient, `concurrency` at a time, after `warmup`
+# unrecorded ones. Every worker has its own seeded generator, so a run always sends the same requests
+async def drive(client, scenario: str, size, requests: int, concurrency: int, warmup: int = 0, seed: int = 0):
+    choose = chooser(scenario)
+
+    async def send(rng, record):
+        name, method, url, body = choose(rng, size)
+        start = time.perf_counter()
+        response = await client.request(method, url, json=body)
+        await response.aread()
+        if record is not None:
+            record.append((name, time.perf_counter() - start, response.status_code))
+
+    warmup_rng = random.Random(f"{seed}-warmup")
+    for _ in range(warmup):
+        await send(warmup_rng, None)
+
+    results = []
+    remaining = iter(range(requests))
+
+    async def worker(index):
+        rng = random.Random(f"{seed}-{scenario}-{index}")
+        for _ in remaining:
+            await send(rng, results)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    by_operation = defaultdict(list)
+    statuses = defaultdict(int)
+    for name, latency, status in results:
+        by_operation[name].append(latency)
+        statuses[status] += 1
+
+    summary = summarize([latency for _, latency, _ in results], seconds)
+    summary["errors"] = sum(count for status, count in statuses.items() if status >= 400)
+    summary["statuses"] = {str(status): count for status, count in sorted(statuses.items())}
+    summary["operations"] = {name: summarize(latencies, seconds) for name, latencies in sorted(by_operation.items())}
+    return summary
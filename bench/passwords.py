@@ -0,0 +1,60 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from security import PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P, _hash, _verify
+
+# usage: python -m bench.passwords --cost 16384 32768 --workers 1 2 4
+#
+# Login throughput: password verifications per second, and per worker process (one core each),
+# for each scrypt cost and size of the password worker pool. Pick KOKOROIKI_PASSWORD_SCRYPT_N and
+# KOKOROIKI_PASSWORD_HASH_WORKERS from it.
+
+PASSWORD = "kokoroiki-bench"
+
+
+def measure(cost: int, workers: int, logins: int):
+    stored = _hash(PASSWORD, n=cost, r=PASSWORD_SCRYPT_R, p=PASSWORD_SCRYPT_P)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # start the workers before timing
+        list(pool.map(_verify, [PASSWORD] * workers, [stored] * workers))
+        start = time.perf_counter()
+        assert all(pool.map(_verify, [PASSWORD] * logins, [stored] * logins))
+        seconds = time.perf_counter() - start
+
+    return {
+        "cost": cost,
+        "workers": workers,
+        "logins_per_second": round(logins / seconds, 2),
+        "logins_per_second_per_worker": round(logins / seconds / workers, 2),
+        "ms_per_login": round(seconds / logins * workers * 1000, 2),
+        "memory_mib_per_hash": round(128 * cost * PASSWORD_SCRYPT_R / 2 ** 20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Password verification throughput per core")
+    parser.add_argument("--cost", type=int, nargs="+", default=[PASSWORD_SCRYPT_N])
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, os.cpu_count() or 1}))
+    parser.add_argument("--logins", type=int, default=100, help="verifications per measurement")
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    results = []
+    for cost in args.cost:
+        for workers in args.workers:
+            result = measure(cost, workers, args.logins)
+            results.append(result)
+            print(
+                f"N={cost:<7} workers={workers:<3} {result['logins_per_second']:>9} logins/s"
+                f"  {result['logins_per_second_per_worker']:>8} per worker  {result['ms_per_login']:>7} ms each"
+            )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"cpu_count": os.cpu_count(), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import httpx
+from bench.load import drive
+from bench.seed import SCALES, seed, sizes
+from bench.scenarios import SCENARIOS
+
+# usage: python -m bench.run --scale 10k --scenario list detail create feed --db-mode sync async
+#        python -m bench.run --scale 100k --transport uvicorn --concurrency 64 --output bench/results/base.json
+#
+# Every configuration (transport x db mode x fast JSON) runs against a fresh copy of the seeded database,
+# with the app in its own process so the KOKOROIKI_* settings are read anew.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _database(workdir: str, scale: str, seed_value: int, reseed: bool):
+    pristine = os.path.join(workdir, f"{scale}-seed{seed_value}.db")
+    if reseed or not os.path.exists(pristine):
+        print(f"seeding {scale} posts into {pristine}", file=sys.stderr)
+        seed(pristine, SCALES[scale], seed_value)
+    return pristine
+
+
+# A directory holding a fresh copy of the seeded database as kokoroiki.db, where the app is started
+def _fresh_copy(pristine: str, workdir: str):
+    rundir = os.path.join(workdir, "run")
+    shutil.rmtree(rundir, ignore_errors=True)
+    os.makedirs(rundir)
+    shutil.copyfile(pristine, os.path.join(rundir, "kokoroiki.db"))
+    return rundir
+
+
+def _environment(config, extra):
+    env = dict(os.environ)
+    env.update(extra)
+    env["KOKOROIKI_DB_MODE"] = config["db_mode"]
+    env["KOKOROIKI_FAST_JSON"] = config["fast_json"]
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+    return env
+
+
+async def run_scenarios(client, spec):
+    size = sizes(SCALES[spec["scale"]])
+    results = {}
+    for scenario in spec["scenarios"]:
+        results[scenario] = await drive(
+            client, scenario, size, spec["requests"], spec["concurrency"], spec["warmup"], spec["seed"],
+        )
+    return results
+
+
+# Child process of an "asgi" configuration: the app is imported here and called in-process through httpx
+async def _run_in_process(spec):
+    import main
+
+    async with main.app.router.lifespan_context(main.app):
+        # an exception in a route counts as a 500, as it would behind a server
+        transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            return await run_scenarios(client, spec)
+
+
+def _run_asgi(spec, rundir, env):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as output:
+        path = output.name
+    try:
+        subprocess.run(
+            [sys.executable, "-m", "bench.run", "--child", json.dumps(spec), "--output", path],
+            cwd=rundir, env=env, check=True,
+        )
+        with open(path) as file:
+            return json.load(file)
+    finally:
+        os.remove(path)
+
+
+# A real server: uvicorn in its own process, driven over HTTP on localhost
+def _run_uvicorn(spec, rundir, env, port: int):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=rundir, env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if httpx.get(f"{base_url}/openapi.json").status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("uvicorn did not start")
+            time.sleep(0.2)
+
+        async def run():
+            limits = httpx.Limits(max_connections=spec["concurrency"], max_keepalive_connections=spec["concurrency"])
+            async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+                return await run_scenarios(client, spec)
+
+        return asyncio.run(run())
+    finally:
+        # SIGINT lets uvicorn run the shutdown handlers (buffer flushes) like a normal stop
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def _metadata(args):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": args.scale,
+        "posts": SCALES[args.scale],
+        "seed": args.seed,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "warmup": args.warmup,
+        "env": dict(args.env),
+    }
+
+
+def _print_table(runs):
+    print(f"{'transport':9} {'db':5} {'json':4} {'scenario':8} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>6}")
+    for run in runs:
+        for scenario, result in run["scenarios"].items():
+            latency = result["latency_ms"]
+            print(
+                f"{run['transport']:9} {run['db_mode']:5} {run['fast_json']:4} {scenario:8} {result['rps']:>9} "
+                f"{latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9} {result['errors']:>6}"
+            )
+
+
+def _key_value(text):
+    key, _, value = text.partition("=")
+    return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark of the kokoroiki API")
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reseed", action="store_true", help="regenerate the seeded database")
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=["list", "detail", "create", "feed"])
+    parser.add_argument("--requests", type=int, default=1000, help="recorded requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--transport", nargs="+", choices=("asgi", "uvicorn"), default=["asgi"])
+    parser.add_argument("--db-mode", nargs="+", choices=("sync", "async"), default=["sync"])
+    parser.add_argument("--fast-json", nargs="+", choices=("0", "1"), default=["0"])
+    parser.add_argument("--env", type=_key_value, action="append", default=[], metavar="KEY=VALUE",
+                        help="extra setting for the app, e.g. KOKOROIKI_LIKE_FLUSH_SECONDS=1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workdir", default=os.path.join(REPO_ROOT, "bench", ".work"))
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.output, "w") as file:
+            json.dump(asyncio.run(_run_in_process(json.loads(args.child))), file)
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    pristine = _database(args.workdir, args.scale, args.seed, args.reseed)
+    spec = {
+        "scale": args.scale, "scenarios": args.scenario, "requests": args.requests,
+        "concurrency": args.concurrency, "warmup": args.warmup, "seed": args.seed,
+    }
+
+    runs = []
+    for transport, db_mode, fast_json in itertools.product(args.transport, args.db_mode, args.fast_json):
+        config = {"transport": transport, "db_mode": db_mode, "fast_json": fast_json}
+        print(f"running {config}", file=sys.stderr)
+        rundir = _fresh_copy(pristine, args.workdir)
+        env = _environment(config, dict(args.env))
+        if transport == "asgi":
+            scenarios = _run_asgi(spec, rundir, env)
+        else:
+            scenarios = _run_uvicorn(spec, rundir, env, args.port)
+        runs.append({**config, "scenarios": scenarios})
+
+    output = args.output or os.path.join(
+        REPO_ROOT, "bench", "results", f"{args.scale}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({"meta": _metadata(args), "runs": runs}, file, indent=2)
+
+    _print_table(runs)
+    print(f"results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from pagination import encode_cursor
+from bench.seed import PASSWORD, WORDS
+
+# A scenario is a weighted mix of operations. Each operation takes the random generator and the seeded
+# table sizes and returns (name, method, url, json body)
+
+
+def list_posts(rng, size):
+    after = rng.randint(1, size["posts"])
+    return "list posts", "GET", f"/posts?limit=50&after={encode_cursor(after)}", None
+
+
+def list_users(rng, size):
+    return "list users", "GET", "/app-users?limit=50", None
+
+
+def list_comments(rng, size):
+    return "list comments", "GET", "/comments?limit=100", None
+
+
+def post_detail(rng, size):
+    return "post detail", "GET", f"/posts/{rng.randint(1, size['posts'])}", None
+
+
+def user_detail(rng, size):
+    return "user detail", "GET", f"/app-users/{rng.randint(1, size['users'])}", None
+
+
+def quest_detail(rng, size):
+    return "quest detail", "GET", f"/quests/{rng.randint(1, size['quests'])}", None
+
+
+def create_post(rng, size):
+    body = {
+        "user_id": rng.randint(1, size["users"]), "kids": 1,
+        "content": "benchmark post", "image_url": "images/bench.jpg", "like": 0,
+    }
+    return "create post", "POST", "/posts", body
+
+
+def create_comment(rng, size):
+    body = {
+        "parent_id": 0, "post_id": rng.randint(1, size["posts"]),
+        "user_id": rng.randint(1, size["users"]), "content": "benchmark comment",
+    }
+    return "create comment", "POST", "/comments", body
+
+
+def like_post(rng, size):
+    return "like post", "POST", f"/posts/{rng.randint(1, size['posts'])}/like", None
+
+
+def family_feed(rng, size):
+    return "family feed", "GET", f"/families/{rng.randint(1, size['families'])}/feed?limit=20", None
+
+
+def comment_tree(rng, size):
+    return "comment tree", "GET", f"/posts/{rng.randint(1, size['posts'])}/comments/tree", None
+
+
+def dashboard(rng, size):
+    return "dashboard", "GET", "/dashboard", None
+
+
+def login(rng, size):
+    body = {"email": f"user{rng.randint(1, size['users'])}@example.com", "password": PASSWORD}
+    return "login", "POST", "/login", body
+
+
+def search(rng, size):
+    return "search", "GET", f"/search?q={rng.choice(WORDS)}&limit=20", None
+
+
+def family_search(rng, size):
+    return "family search", "GET", f"/search?q={rng.choice(WORDS)}&family_id={rng.randint(1, size['families'])}", None
+
+
+SCENARIOS = {
+    "list": [(3, list_posts), (1, list_users), (1, list_comments)],
+    "detail": [(3, post_detail), (2, user_detail), (1, quest_detail)],
+    "create": [(1, create_post), (2, create_comment)],
+    "feed": [(3, family_feed), (2, comment_tree), (1, dashboard)],
+    "login": [(1, login)],
+    "search": [(3, search), (1, family_search)],
+    # reads dominate, as in the app's traffic
+    "mixed": [
+        (2, list_posts), (4, post_detail), (2, user_detail), (3, family_feed), (1, comment_tree),
+        (1, create_post), (1, create_comment), (2, like_post),
+    ],
+}
+
+
+# Function picking the next request of a scenario
+def chooser(name: str):
+    weights, operations = zip(*SCENARIOS[name])
+
+    def choose(rng, size):
+        return rng.choices(operations, weights)[0](rng, size)
+
+    return choose
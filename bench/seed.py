@@ -0,0 +1,194 @@
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event, text
+from security import _hash
+import migrations
+import models
+
+# usage: python -m bench.seed --scale 100k --path bench/.work/100k/kokoroiki.db
+
+# Posts per scale; every other table is sized from it
+SCALES = {
+    "1k": 1_000,
+    "10k": 10_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+}
+
+POSTS_PER_USER = 20
+USERS_PER_FAMILY = 4
+COMMENTS_PER_POST = 3  # mean of an exponential fan-out, so a few posts get long threads
+REPLY_RATIO = 0.3
+CLOSENESS_PER_TREE = 5
+QUEST_TYPES = 10
+REWARDS = 20
+PROFILES_PER_USER = 1
+
+# Every seeded user logs in with this password (scenario "login")
+PASSWORD = "kokoroiki-bench"
+# Cheap cost for the seeded hashes; logins are re-hashed with the app's cost
+SEED_SCRYPT_N = 2 ** 10
+
+INSERT_BATCH = 10_000
+EPOCH = datetime(2024, 1, 1)
+WORDS = (
+    "tree water leaf family quest grow sun rain walk park cook story game music school "
+    "garden flower seed hug smile dinner picnic draw read sing"
+).split()
+
+
+# Table sizes for a number of posts
+def sizes(posts: int):
+    users = max(posts // POSTS_PER_USER, USERS_PER_FAMILY)
+    families = -(-users // USERS_PER_FAMILY)
+    return {
+        "posts": posts,
+        "users": users,
+        "families": families,
+        "trees": families,
+        "quest_types": QUEST_TYPES,
+        "rewards": REWARDS,
+        "quests": users,
+        "profiles": users * PROFILES_PER_USER,
+    }
+
+
+def _batches(rows, size=INSERT_BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(connection, model, rows):
+    count = 0
+    for batch in _batches(rows):
+        connection.execute(model.__table__.insert(), batch)
+        count += len(batch)
+    return count
+
+
+def _timestamp(rng, days=365):
+    return EPOCH + timedelta(seconds=rng.randrange(days * 86400))
+
+
+# Fill a new database at `path` with `posts` posts and the matching users, families, comments and the rest.
+# The same seed always produces the same rows. Returns the number of rows per table
+def seed(path: str, posts: int, seed: int = 0):
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    bind = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(bind, "connect")
+    def fast_load(dbapi_connection, connection_record):
+        # a lost seed is simply regenerated, so skip the journal and fsyncs
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=OFF")
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.close()
+
+    migrations.create_schema(bind)
+
+    rng = random.Random(seed)
+    size = sizes(posts)
+    password = _hash(PASSWORD, n=SEED_SCRYPT_N)
+    counts = {}
+
+    with bind.begin() as connection:
+        counts["Families"] = _insert(connection, models.Family, (
+            {"id": id, "name": f"family {id}", "createdAt": EPOCH, "updatedAt": EPOCH}
+            for id in range(1, size["families"] + 1)
+        ))
+
+        def users():
+            for id in range(1, size["users"] + 1):
+                created = _timestamp(rng)
+                yield {
+                    "id": id, "name": f"user {id}", "email": f"user{id}@example.com", "password": password,
+                    "birth": rng.randint(1950, 2020), "age": rng.randint(3, 80), "gender": rng.choice("fm"),
+                    "quest_role": rng.random() < 0.5, "family_id": (id - 1) // USERS_PER_FAMILY + 1,
+                    "last_login": created, "createdAt": created, "updatedAt": created, "publishedAt": created,
+                }
+        counts["Users"] = _insert(connection, models.AppUser, users())
+
+        counts["Profiles"] = _insert(connection, models.Profile, (
+            {"id": id, "name": f"profile {id}", "image": f"profiles/{id}.png", "content": "hello"}
+            for id in range(1, size["profiles"] + 1)
+        ))
+
+        # the most active 1% of users write a fifth of the posts
+        popular = max(size["users"] // 100, 1)
+
+        def posts():
+            for id in range(1, size["posts"] + 1):
+                created = _timestamp(rng)
+                yield {
+                    "id": id,
+                    "user_id": rng.randint(1, popular) if rng.random() < 0.2 else rng.randint(1, size["users"]),
+                    "kids": rng.randint(0, 3), "content": f"post {id} " + " ".join(rng.choices(WORDS, k=12)),
+                    "image_url": f"images/{id}.jpg", "like": int(rng.expovariate(1 / 10)),
+                    "createdAt": created, "updatedAt": created, "publishedAt": created,
+                }
+        counts["Posts"] = _insert(connection, models.Post, posts())
+
+        def comments():
+            id = 0
+            for post_id in range(1, size["posts"] + 1):
+                thread = []
+                for _ in range(int(rng.expovariate(1 / COMMENTS_PER_POST))):
+                    id += 1
+                    parent_id = rng.choice(thread) if thread and rng.random() < REPLY_RATIO else 0
+                    thread.append(id)
+                    yield {
+                        "id": id, "parent_id": parent_id, "post_id": post_id,
+                        "user_id": rng.randint(1, size["users"]), "content": " ".join(rng.choices(WORDS, k=6)),
+                        "createdAt": _timestamp(rng),
+                    }
+        counts["Comments"] = _insert(connection, models.Comment, comments())
+
+        counts["Trees"] = _insert(connection, models.Tree, (
+            {"id": id, "growth_stage": rng.randint(0, 5), "quest": rng.randint(0, 10), "watering": _timestamp(rng)}
+            for id in range(1, size["trees"] + 1)
+        ))
+        counts["Closenesses"] = _insert(connection, models.Closeness, (
+            {"tree_id": tree_id, "close_meter": rng.randint(0, 100)}
+            for tree_id in range(1, size["trees"] + 1) for _ in range(CLOSENESS_PER_TREE)
+        ))
+        counts["QuestTypes"] = _insert(connection, models.QuestType, (
+            {"id": id, "kinds": f"kind {id}", "online": id % 2 == 0} for id in range(1, size["quest_types"] + 1)
+        ))
+        counts["Rewards"] = _insert(connection, models.Reward, (
+            {"id": id, "content": f"reward {id}"} for id in range(1, size["rewards"] + 1)
+        ))
+        counts["Quests"] = _insert(connection, models.Quest, (
+            {"id": id, "content": id, "quest_kinds": rng.randint(1, size["quest_types"]), "completed": rng.random() < 0.4}
+            for id in range(1, size["quests"] + 1)
+        ))
+
+    with bind.connect() as connection:
+        connection.execute(text("ANALYZE"))
+    bind.dispose()
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a reproducible kokoroiki.db for the benchmarks")
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--path", default="kokoroiki.db")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for table, count in seed(args.path, SCALES[args.scale], args.seed).items():
+        print(f"{table:12} {count:>10}")
+    print(f"seeded {args.path} in {time.perf_counter() - start:.1f}s")
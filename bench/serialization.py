@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import tempfile
+import timeit
+from typing import List
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.utils import create_response_field
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from bench.seed import POSTS_PER_USER, seed
+from loaders import eager_options
+from serializers import fast_response, orjson
+import models
+import schemas
+
+# usage: python -m bench.serialization --rows 50 500
+#
+# Microbenchmark of the response path of a list route: response_model validation + jsonable_encoder + json
+# (what FastAPI does with the returned ORM rows) against the precompiled serializer + orjson of KOKOROIKI_FAST_JSON.
+
+RESOURCES = {
+    "posts": (models.Post, schemas.Post),
+    "app-users": (models.AppUser, schemas.AppUser),
+    "comments": (models.Comment, schemas.Comment),
+}
+
+
+def response_model_path(field):
+    def render(rows):
+        value, errors = field.validate(rows, {}, loc=("response",))
+        return JSONResponse(jsonable_encoder(value)).body
+    return render
+
+
+def fast_path(model, schema):
+    def render(rows):
+        return fast_response(model, schema, rows).body
+    return render
+
+
+def measure(render, rows, repeat: int):
+    number = max(1, 2000 // len(rows))
+    best = min(timeit.repeat(lambda: render(rows), number=number, repeat=repeat)) / number
+    return {"ms_per_response": round(best * 1000, 4), "rows_per_second": round(len(rows) / best)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serialization microbenchmark")
+    parser.add_argument("--rows", type=int, nargs="+", default=[50, 500])
+    parser.add_argument("--resource", nargs="+", choices=RESOURCES, default=list(RESOURCES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    results = {"orjson": orjson is not None, "resources": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "kokoroiki.db")
+        # enough users for the largest page of users too
+        seed(path, max(args.rows) * POSTS_PER_USER)
+        bind = create_engine(f"sqlite:///{path}")
+
+        with Session(bind) as session:
+            for resource in args.resource:
+                model, schema = RESOURCES[resource]
+                field = create_response_field(name="response", type_=List[schema])
+                results["resources"][resource] = {}
+                for count in args.rows:
+                    rows = session.query(model).options(*eager_options(model, schema)).order_by(model.id).limit(count).all()
+                    slow, fast = response_model_path(field), fast_path(model, schema)
+                    # both paths have to produce the same document
+                    assert json.loads(slow(rows)) == json.loads(fast(rows)), f"{resource}: outputs differ"
+
+                    before, after = measure(slow, rows, args.repeat), measure(fast, rows, args.repeat)
+                    speedup = round(before["ms_per_response"] / after["ms_per_response"], 2)
+                    results["resources"][resource][count] = {"response_model": before, "fast": after, "speedup": speedup}
+                    print(
+                        f"{resource:10} {count:>5} rows  response_model {before['ms_per_response']:>9} ms"
+                        f"  fast {after['ms_per_response']:>9} ms  x{speedup}"
+                    )
+        bind.dispose()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from bench.seed import SCALES, seed
+
+# usage: python -m bench.startup --scale 10k --repeat 10
+#        python -m bench.startup --repo /path/to/other/checkout --output bench/results/startup-before.json
+#
+# Cold start of one app process, as a server worker or a test session pays it: a new interpreter imports main,
+# runs the startup hooks and answers one request. "worker" starts against an existing seeded database,
+# "test" against an empty one whose schema the process has to create. --repo measures another checkout
+# (e.g. an older commit in a git worktree) with the same seeded database.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the measured process. Works with both the import-time app (main.app) and the create_app factory
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client_imported = time.perf_counter()
+if hasattr(main, "create_app") and sys.argv[1] == "test":
+    from settings import Settings
+    app = main.create_app(Settings(database_url="sqlite://", create_schema=True))
+else:
+    app = main.app
+with TestClient(app) as client:
+    started = time.perf_counter()
+    status = client.get("/families?limit=1").status_code
+    answered = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "startup_ms": (started - client_imported) * 1000,
+    "first_request_ms": (answered - started) * 1000,
+    "status": status,
+}))
+"""
+
+
+def _measure(repo: str, mode: str, rundir: str):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = repo
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", CHILD, mode], cwd=rundir, env=env, capture_output=True, text=True, check=True,
+    )
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def _run(repo: str, mode: str, pristine: str, workdir: str, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        rundir = os.path.join(workdir, "run")
+        shutil.rmtree(rundir, ignore_errors=True)
+        os.makedirs(rundir)
+        if mode == "worker":
+            shutil.copyfile(pristine, os.path.join(rundir, "kokoroiki.db"))
+        samples.append(_measure(repo, mode, rundir))
+
+    statuses = {sample["status"] for sample in samples}
+    summary = {"status": sorted(statuses)}
+    for key in ("import_ms", "startup_ms", "first_request_ms", "process_ms"):
+        summary[key] = round(statistics.median(sample[key] for sample in samples), 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of an app process")
+    parser.add_argument("--repo", default=REPO_ROOT, help="checkout whose main.py is measured")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--mode", choices=["worker", "test"], nargs="+", default=["worker", "test"])
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        pristine = os.path.join(workdir, "seed.db")
+        seed(pristine, SCALES[args.scale])
+        for mode in args.mode:
+            results[mode] = _run(os.path.abspath(args.repo), mode, pristine, workdir, args.repeat)
+            print(mode, json.dumps(results[mode]))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"repo": os.path.abspath(args.repo), "scale": args.scale, "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
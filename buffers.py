@@ -0,0 +1,186 @@
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import bindparam, func, or_
+from sqlalchemy.orm.attributes import set_committed_value
+from writes import like_after
+import models
+
+logger = logging.getLogger(__name__)
+
+# Seconds between flushes of buffered likes. 0 disables the buffer and every like is its own UPDATE
+LIKE_FLUSH_SECONDS = float(os.getenv("KOKOROIKI_LIKE_FLUSH_SECONDS", "0"))
+
+# Seconds between flushes of buffered timestamp touches (last_login, watering), which is also the most
+# a touch can stay unwritten. 0 disables the buffers and every touch is its own UPDATE
+TOUCH_FLUSH_SECONDS = float(os.getenv("KOKOROIKI_TOUCH_FLUSH_SECONDS", "0"))
+# Ids a touch buffer holds before it flushes without waiting for the interval
+TOUCH_MAX_PENDING = int(os.getenv("KOKOROIKI_TOUCH_MAX_PENDING", "10000"))
+
+LIKE_INCREMENT = (
+    models.Post.__table__.update()
+    .where(models.Post.__table__.c.id == bindparam("post_id"))
+    .values(like=like_after(bindparam("delta")), updatedAt=bindparam("now"))
+)
+
+
+# Background thread that calls flush() every `interval` seconds, and once more when stopped
+class PeriodicFlush:
+    name = "buffer"
+
+    def __init__(self, bind, interval: float):
+        self.bind = bind
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def flush(self):
+        raise NotImplementedError
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    # Stop the flusher and write whatever is still pending
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+# Merges bursts of likes per post in memory and applies them periodically with one executemany UPDATE,
+# so a popular post costs one write per interval instead of one write transaction per like.
+class LikeBuffer(PeriodicFlush):
+    name = "like-buffer"
+
+    def __init__(self, bind, interval: float):
+        super().__init__(bind, interval)
+        self.pending = defaultdict(int)
+
+    def add(self, post_id: int, n: int):
+        with self.lock:
+            self.pending[post_id] += n
+
+    # Write every pending increment, returns the number of posts updated
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(int)
+
+        now = datetime.today()
+        params = [{"post_id": post_id, "delta": delta, "now": now} for post_id, delta in pending.items() if delta]
+        if not params:
+            return 0
+
+        try:
+            with self.bind.begin() as connection:
+                connection.execute(LIKE_INCREMENT, params)
+        except Exception:
+            # keep the increments for the next flush rather than dropping them
+            logger.exception("flushing %d buffered likes failed", len(params))
+            with self.lock:
+                for post_id, delta in pending.items():
+                    self.pending[post_id] += delta
+            return 0
+
+        return len(params)
+
+
+# Keeps the latest timestamp per id of one frequently touched column (AppUser.last_login, Tree.watering)
+# and writes them all with one executemany UPDATE per interval, so touches don't each take SQLite's writer.
+# A touch is written at most `interval` seconds late (sooner when `max_pending` ids are waiting);
+# until then overlay() puts it on rows read from the database, so the caller reads its own write.
+class TouchBuffer(PeriodicFlush):
+    def __init__(self, bind, model, column: str, interval: float, max_pending: int = TOUCH_MAX_PENDING):
+        super().__init__(bind, interval)
+        self.name = f"{model.__tablename__}-{column}-buffer"
+        self.model = model
+        self.column = column
+        self.max_pending = max_pending
+        self.pending = {}
+
+        table = model.__table__
+        touched = bindparam("touched", type_=table.c[column].type)
+        values = {column: touched}
+        if "updatedAt" in table.c:
+            # a later PUT may have set updatedAt past the touch, keep the later one
+            values["updatedAt"] = func.max(func.coalesce(table.c.updatedAt, touched), touched)
+        # never moves the column back, e.g. behind a value written directly by a PUT in the meantime
+        self.statement = (
+            table.update()
+            .where(
+                table.c.id == bindparam("row_id"),
+                or_(table.c[column].is_(None), table.c[column] < touched),
+            )
+            .values(**values)
+        )
+
+    def touch(self, id: int, value: datetime):
+        with self.lock:
+            current = self.pending.get(id)
+            if current is None or current < value:
+                self.pending[id] = value
+            full = len(self.pending) >= self.max_pending
+        if full:
+            self.wakeup.set()
+
+    # Whether the row with this id (or any row, without an id) has a touch not written yet
+    def has_pending(self, id: int = None):
+        with self.lock:
+            return bool(self.pending) if id is None else id in self.pending
+
+    # Put the pending touches on rows (or a single row) loaded from the database, without marking them dirty.
+    # Call it inside the session's run, before the rows are rendered
+    def overlay(self, rows):
+        with self.lock:
+            if not self.pending:
+                return rows
+            pending = dict(self.pending)
+
+        columns = [self.column] + (["updatedAt"] if "updatedAt" in self.model.__table__.c else [])
+        for row in rows if isinstance(rows, list) else [rows]:
+            value = pending.get(getattr(row, "id", None))
+            if value is None:
+                continue
+            for column in columns:
+                # read from the instance dict: a column left out by load_only must not trigger a lazy load
+                current = row.__dict__.get(column)
+                if current is None or current < value:
+                    set_committed_value(row, column, value)
+        return rows
+
+    # Write every pending touch, returns the number of rows touched
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        params = [{"row_id": id, "touched": value} for id, value in pending.items()]
+        if not params:
+            return 0
+
+        try:
+            with self.bind.begin() as connection:
+                connection.execute(self.statement, params)
+        except Exception:
+            # keep the touches for the next flush, unless a newer one arrived meanwhile
+            logger.exception("flushing %d buffered %s touches failed", len(params), self.column)
+            with self.lock:
+                for id, value in pending.items():
+                    if id not in self.pending or self.pending[id] < value:
+                        self.pending[id] = value
+            return 0
+
+        return len(params)
@@ -0,0 +1,214 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from loaders import schema_columns
+from pagination import PageParams
+import models
+import schemas
+
+# Seconds a cached row stays valid, even without a write that invalidates it (other worker processes)
+CACHE_TTL_SECONDS = float(os.getenv("KOKOROIKI_CACHE_TTL_SECONDS", "300"))
+# Entries kept per cached table
+CACHE_MAXSIZE = int(os.getenv("KOKOROIKI_CACHE_MAXSIZE", "1024"))
+
+_ALL = "__all__"
+
+
+# Bounded LRU mapping whose entries expire after `ttl` seconds
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns (True, value) on a hit and (False, None) on a miss
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+# Read-through cache of a small, read-mostly table, holding rows as response schema objects
+class ReferenceCache:
+    def __init__(self, model, schema, maxsize: int = CACHE_MAXSIZE, ttl: float = CACHE_TTL_SECONDS):
+        self.model = model
+        self.schema = schema
+        self.columns = schema_columns(model, schema)
+        self.entries = LRUCache(maxsize, ttl)
+        # bumped by every invalidation, so a load that raced with a write is not stored
+        self.generation = 0
+
+    def _snapshot(self, row):
+        return self.schema(**{name: getattr(row, name) for name in self.columns})
+
+    # Entries are kept per engine, so apps on different databases (main.app, a test's app) never share rows
+    @staticmethod
+    def _key(session, key):
+        return session.get_bind(), key
+
+    def _load(self, key, fetch):
+        generation = self.generation
+        value = fetch()
+        if generation == self.generation:
+            self.entries.put(key, value)
+        return value
+
+    # Every row, ordered by id
+    def all(self, session):
+        found, rows = self.entries.get(self._key(session, _ALL))
+        if found:
+            return rows
+
+        generation = self.generation
+        rows = tuple(self._snapshot(row) for row in session.query(self.model).order_by(self.model.id))
+        if generation == self.generation:
+            # the single rows too, so detail lookups hit right after a preload
+            for row in rows[:self.entries.maxsize - 1]:
+                self.entries.put(self._key(session, row.id), row)
+            self.entries.put(self._key(session, _ALL), rows)
+
+        return rows
+
+    # The row with the given id, or None
+    def get(self, session, id: int):
+        found, row = self.entries.get(self._key(session, id))
+        if found:
+            return row
+
+        def fetch():
+            row = session.query(self.model).get(id)
+            return None if row is None else self._snapshot(row)
+
+        return self._load(self._key(session, id), fetch)
+
+    # {id: row or None} for several ids; the ones not cached are loaded with a single IN query
+    def get_many(self, session, ids):
+        rows, missing = {}, set()
+        for id in set(ids) - {None}:
+            found, row = self.entries.get(self._key(session, id))
+            if found:
+                rows[id] = row
+            else:
+                missing.add(id)
+        if not missing:
+            return rows
+
+        generation = self.generation
+        loaded = {row.id: self._snapshot(row) for row in session.query(self.model).filter(self.model.id.in_(missing))}
+        for id in missing:
+            rows[id] = loaded.get(id)
+            if generation == self.generation:
+                self.entries.put(self._key(session, id), rows[id])
+        return rows
+
+    # One page of the table, with the same cursor and Link header as pagination.paginate
+    def page(self, session, page: PageParams):
+        rows = self.all(session)
+        after_id = page.after_id
+        if after_id is not None:
+            rows = [row for row in rows if row.id > after_id]
+
+        if len(rows) > page.limit:
+            rows = rows[:page.limit]
+            page.set_next(rows[-1].id)
+
+        return list(rows)
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries.clear()
+
+
+quest_types = ReferenceCache(models.QuestType, schemas.QuestType)
+rewards = ReferenceCache(models.Reward, schemas.Reward)
+
+REFERENCE_CACHES = {
+    "quest_types": quest_types,
+    "rewards": rewards,
+}
+_CACHES_BY_MODEL = {cache.model: cache for cache in REFERENCE_CACHES.values()}
+
+
+def preload(session):
+    for cache in REFERENCE_CACHES.values():
+        cache.all(session)
+
+
+def stats():
+    return {name: cache.entries.stats() for name, cache in REFERENCE_CACHES.items()}
+
+
+# Invalidation: remember which cached tables a session wrote to, drop those caches once the transaction commits.
+def _touched(session):
+    return session.info.setdefault("touched_reference_tables", set())
+
+
+@event.listens_for(Session, "after_flush")
+def _track_flushed_rows(session, flush_context):
+    for row in list(session.new) + list(session.dirty) + list(session.deleted):
+        if type(row) in _CACHES_BY_MODEL:
+            _touched(session).add(type(row))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_bulk_statements(orm_execute_state):
+    # insert()/update()/delete() statements never show up in session.new/dirty/deleted
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ in _CACHES_BY_MODEL:
+            _touched(orm_execute_state.session).add(mapper.class_)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    for model in session.info.pop("touched_reference_tables", ()):
+        _CACHES_BY_MODEL[model].invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back(session):
+    session.info.pop("touched_reference_tables", None)
+
+
+def _quest(quest, quest_type):
+    data = {name: getattr(quest, name) for name in schema_columns(models.Quest, schemas.Quest)}
+    return schemas.Quest(quests=quest_type, **data)
+
+
+# Quest response with its QuestType taken from the cache instead of a join
+def quest_with_type(session, quest):
+    return _quest(quest, quest_types.get(session, quest.quest_kinds))
+
+
+# The same for a page of quests: the QuestTypes missing from the cache are loaded together, not one by one
+def quests_with_types(session, quests):
+    types = quest_types.get_many(session, [quest.quest_kinds for quest in quests])
+    return [_quest(quest, types.get(quest.quest_kinds)) for quest in quests]
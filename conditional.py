@@ -0,0 +1,129 @@
+import hashlib
+import typing
+from functools import lru_cache
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request, Response
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from database import Base
+from loaders import nested_schema
+
+
+# Change counter per table, kept by triggers on every insert, update and delete, so a list validator reads
+# one row per table by primary key instead of aggregating the tables. changedAt is the last change (UTC),
+# deletes included. Not on Base.metadata: migrations.py creates it with its triggers.
+_versions_metadata = MetaData()
+table_versions = Table(
+    "TableVersions", _versions_metadata,
+    Column("name", String, primary_key=True),
+    Column("version", Integer, nullable=False),
+    Column("changedAt", DateTime),
+)
+
+
+# Migration: the counter table and the triggers of every table whose rows carry an updatedAt
+def create_table_versions(connection):
+    table_versions.create(connection, checkfirst=True)
+    bump = (
+        f'UPDATE "{table_versions.name}" SET version = version + 1, '
+        "\"changedAt\" = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE name = '{name}'; "
+    )
+    for table in Base.metadata.sorted_tables:
+        if "updatedAt" not in table.c:
+            continue
+        connection.execute(text(
+            f'INSERT OR IGNORE INTO "{table_versions.name}"(name, version, "changedAt") '
+            "VALUES (:name, 0, strftime('%Y-%m-%d %H:%M:%f', 'now'))"
+        ), {"name": table.name})
+        for operation in ("insert", "update", "delete"):
+            connection.execute(text(
+                f'CREATE TRIGGER IF NOT EXISTS "{table.name}_version_{operation}" '
+                f'AFTER {operation.upper()} ON "{table.name}" BEGIN {bump.format(name=table.name)}END'
+            ))
+
+
+# The models whose updatedAt versions a response of `schema`, with the relationship path that reaches each one
+def _versioned(model, schema, path=()):
+    versioned = [(model, path)] if "updatedAt" in inspect(model).columns else []
+    relationships = inspect(model).relationships
+    for name, annotation in typing.get_type_hints(schema).items():
+        nested = nested_schema(annotation)
+        if nested is not None and name in relationships:
+            versioned += _versioned(relationships[name].mapper.class_, nested, path + (getattr(model, name),))
+    return versioned
+
+
+@lru_cache(maxsize=None)
+def versioned_models(model, schema):
+    return tuple(_versioned(model, schema))
+
+
+def _http_date(value):
+    # timestamps are stored naive; they are read and compared the same way, so treat them as UTC
+    return format_datetime(value.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+
+# Strong ETag / Last-Modified validators computed from updatedAt, and the 304 answer to a matching revalidation.
+# The validators are read with one small query before any row is hydrated or validated by Pydantic.
+class ConditionalGet:
+    def __init__(self, request: Request, response: Response):
+        self.request = request
+        self.response = response
+        self.fresh = False
+
+    # Set the validators for the current representation and report whether the client's copy is still current
+    def _evaluate(self, versions, last_modified):
+        key = repr((self.request.url.path, self.request.url.query, versions)).encode()
+        etag = f'"{hashlib.sha1(key).hexdigest()}"'
+        self.response.headers["ETag"] = etag
+        if last_modified is not None:
+            self.response.headers["Last-Modified"] = _http_date(last_modified)
+
+        if_none_match = self.request.headers.get("if-none-match")
+        if if_none_match is not None:
+            candidates = [tag.strip() for tag in if_none_match.split(",")]
+            self.fresh = "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+            return self.fresh
+
+        if_modified_since = self.request.headers.get("if-modified-since")
+        if if_modified_since is not None and last_modified is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            self.fresh = last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+
+        return self.fresh
+
+    # Detail route: the updatedAt of the row and of every nested object in its response.
+    # Returns True when the client's copy is current; a missing row is left for the route to 404
+    def detail(self, session, model, schema, id: int):
+        versioned = versioned_models(model, schema)
+        query = session.query(*[versioned_model.updatedAt for versioned_model, _ in versioned]).select_from(model)
+        for _, path in versioned:
+            if path:
+                query = query.outerjoin(path[-1])
+        row = query.filter(model.id == id).first()
+        if row is None:
+            return False
+
+        versions = tuple(row)
+        return self._evaluate(versions, max((value for value in versions if value is not None), default=None))
+
+    # List route: the change counters of every table in the response, one primary key lookup each.
+    # Any insert, update or delete in those tables moves the ETag and Last-Modified
+    def listing(self, session, model, schema):
+        names = sorted({versioned_model.__tablename__ for versioned_model, _ in versioned_models(model, schema)})
+        query = select(table_versions.c.name, table_versions.c.version, table_versions.c.changedAt).where(
+            table_versions.c.name.in_(names)
+        )
+        rows = sorted(session.execute(query).all())
+
+        versions = tuple((name, version) for name, version, _ in rows)
+        return self._evaluate(versions, max((row.changedAt for row in rows if row.changedAt is not None), default=None))
+
+    def not_modified(self):
+        headers = {name: value for name, value in self.response.headers.items() if name in ("etag", "last-modified")}
+        return Response(status_code=304, headers=headers)
@@ -1,12 +1,126 @@
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
- 
-# Create a sqlite engine instance
-engine = create_engine("sqlite:///kokoroiki.db")
- 
+from starlette.concurrency import run_in_threadpool
+
+# PRAGMAs run on every new SQLite connection, selected with KOKOROIKI_SQLITE_PROFILE (Settings.sqlite_profile).
+# "production" switches to WAL so readers no longer wait behind a committing writer,
+# and to synchronous=NORMAL so a commit no longer fsyncs (WAL stays consistent, only the last commits can be lost on power failure).
+SQLITE_PROFILES = {
+    "default": {},
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,  # 256 MiB of the file read through the page cache of the OS
+        "cache_size": -65536,  # negative means KiB: 64 MiB page cache per connection
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,  # ms a writer waits for the lock instead of failing with "database is locked"
+    },
+}
+
+
+def _sqlite_pragmas(pragmas):
+    def apply(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return apply
+
+
+# Called with the seconds every connection checkout waited (metrics.py records them per request)
+CHECKOUT_WAIT_LISTENERS = []
+
+
+# Times how long a checkout waits for a free (or newly opened) connection; the pool events only fire after it.
+# There is no public hook for the wait: this overrides Pool._do_get, private API that every checkout goes
+# through in SQLAlchemy 1.4 and 2.0 (checked against 2.0.54). A release without it gets the plain pools,
+# and pool waits are then not recorded
+class _TimedCheckout:
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            for listener in CHECKOUT_WAIT_LISTENERS:
+                listener(waited)
+
+
+if all(callable(getattr(pool, "_do_get", None)) for pool in (QueuePool, AsyncAdaptedQueuePool)):
+    class TimedQueuePool(_TimedCheckout, QueuePool):
+        pass
+
+    class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+        pass
+else:
+    TimedQueuePool, TimedAsyncQueuePool = QueuePool, AsyncAdaptedQueuePool
+
+
 # Create a DeclarativeMeta instance
 Base = declarative_base()
- 
-# Create SessionLocal class from sessionmaker factory
-SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
\ No newline at end of file
+
+
+def in_memory(url):
+    return url.database in (None, "", ":memory:")
+
+
+def _pool_options(settings):
+    return {"pool_size": settings.pool_size, "max_overflow": settings.max_overflow, "pool_timeout": settings.pool_timeout}
+
+
+# The engines of one app (main.create_app, or a command line tool) and the session factories bound to them.
+# Creating an engine opens no connection; the database file is first touched by the first query.
+# The async engine and its sessions only exist in async mode, aiosqlite is not needed otherwise
+class Database:
+    def __init__(self, settings):
+        url = make_url(settings.database_url)
+        # an in-memory database lives in its connection: keep exactly one, shared by every session
+        options = {"poolclass": StaticPool} if in_memory(url) else _pool_options(settings)
+        apply_pragmas = _sqlite_pragmas(SQLITE_PROFILES[settings.sqlite_profile])
+
+        self.mode = settings.db_mode
+        self.engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False},  # pooled connections move between threadpool workers
+            **({"poolclass": TimedQueuePool} | options),
+        )
+        event.listen(self.engine, "connect", apply_pragmas)
+        self.sessions = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+        self.async_engine = None
+        self.async_sessions = None
+        if self.mode == "async":
+            from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+            self.async_engine = create_async_engine(
+                url.set(drivername="sqlite+aiosqlite"),
+                **({"poolclass": TimedAsyncQueuePool} | options),
+            )
+            event.listen(self.async_engine.sync_engine, "connect", apply_pragmas)
+            self.async_sessions = async_sessionmaker(bind=self.async_engine, expire_on_commit=False)
+
+    # Close the pooled connections, at app shutdown
+    async def dispose(self):
+        self.engine.dispose()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+
+
+# Runs a read function fn(session) on a sync Session in the threadpool
+class Reader:
+    def __init__(self, session):
+        self.session = session
+
+    async def run(self, fn, *args):
+        return await run_in_threadpool(fn, self.session, *args)
+
+
+# Runs the same read function on an AsyncSession. run_sync keeps the ORM Query API,
+# while every database round trip is awaited on the event loop.
+class AsyncSessionReader(Reader):
+    async def run(self, fn, *args):
+        return await self.session.run_sync(fn, *args)
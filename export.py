@@ -0,0 +1,95 @@
+import csv
+import io
+from enum import Enum
+from fastapi.encoders import jsonable_encoder
+from loaders import eager_options, schema_columns
+import models
+import schemas
+
+# Rows fetched from the cursor per round trip
+EXPORT_BATCH_SIZE = 1000
+# Rows written per chunk of the HTTP response
+EXPORT_CHUNK_ROWS = 100
+
+# Exportable resources, keyed by the path segment of their REST routes
+RESOURCES = {
+    "app-users": (models.AppUser, schemas.AppUser),
+    "profiles": (models.Profile, schemas.Profile),
+    "families": (models.Family, schemas.Family),
+    "posts": (models.Post, schemas.Post),
+    "comments": (models.Comment, schemas.Comment),
+    "trees": (models.Tree, schemas.Tree),
+    "quest_types": (models.QuestType, schemas.QuestType),
+    "rewards": (models.Reward, schemas.Reward),
+    "quests": (models.Quest, schemas.Quest),
+    "closeness": (models.Closeness, schemas.Closeness),
+}
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+}
+
+
+# Iterate over the whole table in id order without materializing it.
+# The generator owns its session (from the app's `sessions` factory) because it outlives the request handler
+# that created the response.
+def iter_rows(sessions, model, schema):
+    session = sessions()
+    try:
+        query = (
+            session.query(model)
+            .options(*eager_options(model, schema))
+            .order_by(model.id)
+            .execution_options(stream_results=True)
+            .yield_per(EXPORT_BATCH_SIZE)
+        )
+        for row in query:
+            yield row
+    finally:
+        session.close()
+
+
+# One JSON document per line, with the same shape as the resource's detail route
+def iter_ndjson(sessions, model, schema):
+    lines = []
+    for row in iter_rows(sessions, model, schema):
+        lines.append(schema.from_orm(row).json() + "\n")
+        if len(lines) >= EXPORT_CHUNK_ROWS:
+            yield "".join(lines)
+            lines = []
+
+    if lines:
+        yield "".join(lines)
+
+
+# Flat CSV of the resource's own columns (nested objects are left out)
+def iter_csv(sessions, model, schema):
+    columns = schema_columns(model, schema)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    count = 0
+    for row in iter_rows(sessions, model, schema):
+        writer.writerow(jsonable_encoder([getattr(row, name) for name in columns]))
+        count += 1
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def iter_export(sessions, resource: str, format: ExportFormat):
+    model, schema = RESOURCES[resource]
+    if format == ExportFormat.csv:
+        return iter_csv(sessions, model, schema)
+    return iter_ndjson(sessions, model, schema)
@@ -0,0 +1,148 @@
+import typing
+from typing import Optional
+from fastapi import HTTPException, Query, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, load_only, selectinload
+from loaders import eager_options, nested_schema, schema_columns
+from serializers import FAST_JSON, FastJSONResponse, fast_response
+
+
+# Split a comma separated query parameter ("user,user.family") into a list of names
+def _split(value: Optional[str]):
+    if value is None:
+        return None
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+# One level of a sparse selection: the columns to load for `model` and the expanded relationships below it
+class _Node:
+    def __init__(self, model, schema, path=""):
+        self.model = model
+        self.schema = schema
+        self.path = path
+        self.columns = None  # None means "every column of the schema"
+        self.children = {}
+
+    def selected_columns(self):
+        columns = schema_columns(self.model, self.schema) if self.columns is None else self.columns
+        # the primary key is always returned, pagination and clients rely on it
+        return ["id"] + [name for name in columns if name != "id"]
+
+    def expand(self, name):
+        if name not in self.children:
+            relationships = inspect(self.model).relationships
+            nested = nested_schema(typing.get_type_hints(self.schema).get(name))
+            if name not in relationships or nested is None:
+                raise HTTPException(status_code=400, detail=f"cannot expand {self.path + name!r}")
+            self.children[name] = _Node(relationships[name].mapper.class_, nested, f"{self.path}{name}.")
+        return self.children[name]
+
+    def select(self, name):
+        if name not in schema_columns(self.model, self.schema):
+            raise HTTPException(status_code=400, detail=f"unknown field {self.path + name!r}")
+        if self.columns is None:
+            self.columns = []
+        if name not in self.columns:
+            self.columns.append(name)
+
+    def options(self, parent=None):
+        options = []
+        columns = [getattr(self.model, name) for name in self.selected_columns()]
+        if parent is None:
+            options.append(load_only(*columns))
+        else:
+            options.append(parent.load_only(*columns))
+
+        relationships = inspect(self.model).relationships
+        for name, child in self.children.items():
+            attribute = getattr(self.model, name)
+            if parent is None:
+                loader = selectinload(attribute) if relationships[name].uselist else joinedload(attribute)
+            else:
+                loader = parent.selectinload(attribute) if relationships[name].uselist else parent.joinedload(attribute)
+            options.extend(child.options(loader))
+
+        return options
+
+    def dump(self, obj):
+        if obj is None:
+            return None
+
+        data = {name: getattr(obj, name) for name in self.selected_columns()}
+        for name, child in self.children.items():
+            value = getattr(obj, name)
+            if isinstance(value, list):
+                data[name] = [child.dump(item) for item in value]
+            else:
+                data[name] = child.dump(value)
+
+        return data
+
+
+# ?fields=content,like,user.name&expand=user,user.family
+# Without either parameter the route keeps its full response_model and schema-derived eager loading.
+# With them, only the listed columns are SELECTed (load_only) and only expanded relationships are joined.
+class FieldSelection:
+    def __init__(
+        self,
+        response: Response,
+        fields: Optional[str] = Query(None, description="comma separated columns, dotted for expanded relationships (user.name)"),
+        expand: Optional[str] = Query(None, description="comma separated relationships to include (user,user.family)"),
+    ):
+        self.response = response
+        self.fields = _split(fields)
+        self.expand = _split(expand)
+        self.root = None
+        self.model = None
+        self.schema = None
+
+    @property
+    def active(self):
+        return self.fields is not None or self.expand is not None
+
+    # Loader options for the route's query
+    def options(self, model, schema):
+        self.model = model
+        self.schema = schema
+        if not self.active:
+            return eager_options(model, schema)
+
+        self.root = _Node(model, schema)
+        if self.fields is not None:
+            # with an explicit field list the top level returns only what was asked for
+            self.root.columns = []
+        for path in self.expand or []:
+            node = self.root
+            for name in path.split("."):
+                node = node.expand(name)
+
+        for path in self.fields or []:
+            *relationships, column = path.split(".")
+            node = self.root
+            for name in relationships:
+                node = node.expand(name)
+            node.select(column)
+
+        return self.root.options()
+
+    # Rows (or a single row) as the route's response. model and schema are the ones given to options(),
+    # or passed here when the rows were loaded without it (e.g. from the reference cache)
+    def render(self, result, model=None, schema=None):
+        model, schema = model or self.model, schema or self.schema
+        if not self.active:
+            # the full representation is left to response_model, unless the fast serializers are switched on
+            if not FAST_JSON or model is None:
+                return result
+            rendered = fast_response(model, schema, result)
+        else:
+            if isinstance(result, list):
+                data = [self.root.dump(row) for row in result]
+            else:
+                data = self.root.dump(result)
+            rendered = FastJSONResponse(data) if FAST_JSON else JSONResponse(jsonable_encoder(data))
+
+        # keep the headers the route set on its Response (Link, ETag, ...), FastAPI only merges them into responses it builds itself
+        rendered.headers.raw.extend(self.response.headers.raw)
+        return rendered
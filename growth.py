@@ -0,0 +1,129 @@
+import os
+import time
+from datetime import datetime
+from sqlalchemy import DateTime, bindparam, func, literal, select
+import models
+
+# numpy, imported by the first tick rather than with the app (most app processes never tick)
+np = None
+
+# Seconds between growth ticks (jobs.PeriodicJob). 0 disables the scheduled job (run `python growth.py` from cron instead)
+GROWTH_INTERVAL_SECONDS = float(os.getenv("KOKOROIKI_GROWTH_INTERVAL_SECONDS", "0"))
+# Trees read, computed and written per chunk, each chunk in its own short write transaction
+GROWTH_CHUNK_SIZE = int(os.getenv("KOKOROIKI_GROWTH_CHUNK_SIZE", "10000"))
+
+# Summed close_meter a tree needs to reach each stage (index = stage); the last index is the final stage
+CLOSENESS_THRESHOLDS = (0, 50, 150, 300, 500, 800)
+MAX_GROWTH_STAGE = len(CLOSENESS_THRESHOLDS) - 1
+# A tree watered within this many days grows one stage per tick, up to what its closeness allows
+GROWTH_WATERED_DAYS = 1.0
+# A tree not watered for this many days (or never) wilts back one stage per tick
+WILT_AFTER_DAYS = 7.0
+
+# Guarded by the stage that was read, so a tree updated through the API in the meantime is left alone
+GROWTH_UPDATE = (
+    models.Tree.__table__.update()
+    .where(
+        models.Tree.__table__.c.id == bindparam("tree_id"),
+        models.Tree.__table__.c.growth_stage == bindparam("previous"),
+    )
+    .values(growth_stage=bindparam("stage"))
+)
+
+
+# Columns of one chunk: tree ids, current stages, days since watering (NULL when never) and summed closeness
+def _chunk_query(now: datetime, after_id: int, size: int):
+    tree, closeness = models.Tree, models.Closeness
+    return (
+        select(
+            tree.id,
+            func.coalesce(tree.growth_stage, 0),
+            func.julianday(literal(now, DateTime)) - func.julianday(tree.watering),
+            func.coalesce(func.sum(closeness.close_meter), 0),
+        )
+        .select_from(tree)
+        .outerjoin(closeness, closeness.tree_id == tree.id)
+        .where(tree.id > after_id)
+        .group_by(tree.id)
+        .order_by(tree.id)
+        .limit(size)
+    )
+
+
+def _numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # the tick still runs without numpy, one row at a time in Python
+            return None
+        np = numpy
+    return np
+
+
+# New stages of a chunk with NumPy, as whole-column operations
+def _grow_vectorized(stages, days_since_watering, closeness):
+    stages = np.asarray(stages, dtype=np.int64)
+    days = np.asarray(days_since_watering, dtype=np.float64)  # None becomes nan
+    reachable = np.searchsorted(CLOSENESS_THRESHOLDS, np.asarray(closeness, dtype=np.float64), side="right") - 1
+
+    watered = days <= GROWTH_WATERED_DAYS
+    wilting = np.isnan(days) | (days > WILT_AFTER_DAYS)
+    grown = np.where(watered & (stages < reachable), np.minimum(stages + 1, MAX_GROWTH_STAGE), stages)
+    return np.where(wilting & (grown > 0), grown - 1, grown)
+
+
+# The same rules, row by row, when numpy is not installed
+def _grow_python(stages, days_since_watering, closeness):
+    new_stages = []
+    for stage, days, meter in zip(stages, days_since_watering, closeness):
+        reachable = sum(1 for threshold in CLOSENESS_THRESHOLDS if meter >= threshold) - 1
+        if days is not None and days <= GROWTH_WATERED_DAYS and stage < reachable:
+            stage = min(stage + 1, MAX_GROWTH_STAGE)
+        if (days is None or days > WILT_AFTER_DAYS) and stage > 0:
+            stage -= 1
+        new_stages.append(stage)
+    return new_stages
+
+
+# Advance every tree by one tick. Trees are read in id order, GROWTH_CHUNK_SIZE at a time, as plain columns
+# (no ORM objects), and the changed ones are written back with one executemany UPDATE per chunk.
+# Returns the number of trees read and changed
+def tick(bind, now: datetime = None, chunk_size: int = GROWTH_CHUNK_SIZE):
+    now = now or datetime.today()
+    grow = _grow_python if _numpy() is None else _grow_vectorized
+    after_id = 0
+    seen = changed = 0
+
+    while True:
+        with bind.connect() as connection:
+            rows = connection.execute(_chunk_query(now, after_id, chunk_size)).all()
+        if not rows:
+            break
+
+        ids, stages, days, closeness = zip(*rows)
+        new_stages = grow(stages, days, closeness)
+        params = [
+            {"tree_id": id, "previous": stage, "stage": int(new_stage)}
+            for id, stage, new_stage in zip(ids, stages, new_stages)
+            if new_stage != stage
+        ]
+        if params:
+            with bind.begin() as connection:
+                connection.execute(GROWTH_UPDATE, params)
+
+        seen += len(rows)
+        changed += len(params)
+        after_id = ids[-1]
+
+    return seen, changed
+
+
+if __name__ == "__main__":
+    from database import Database
+    from settings import Settings
+
+    engine = Database(Settings()).engine
+    start = time.perf_counter()
+    seen, changed = tick(engine)
+    print(f"{seen} trees, {changed} changed in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,383 @@
+import hashlib
+import importlib.util
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import formatdate
+import anyio
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response
+from starlette.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    try:
+        from multipart.multipart import MultipartParser, parse_options_header
+    except ImportError:  # uploads answer 501 without python-multipart
+        MultipartParser = parse_options_header = None
+
+# Pillow is only imported by the thumbnail workers. Without it no thumbnails are made: their URLs serve the original
+PILLOW_INSTALLED = importlib.util.find_spec("PIL") is not None
+
+logger = logging.getLogger(__name__)
+
+# Where uploaded images and their thumbnails are stored, one file per distinct content
+IMAGE_DIR = os.getenv("KOKOROIKI_IMAGE_DIR", "images")
+# Largest upload accepted; a bigger body is cut off with a 413 as soon as it passes this size
+IMAGE_MAX_BYTES = int(os.getenv("KOKOROIKI_IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+# Bytes gathered before each write to disk
+IMAGE_CHUNK_BYTES = int(os.getenv("KOKOROIKI_IMAGE_CHUNK_BYTES", str(256 * 1024)))
+# Longest side, in pixels, of each thumbnail made after an upload
+THUMBNAIL_SIZES = tuple(int(size) for size in os.getenv("KOKOROIKI_THUMBNAIL_SIZES", "160,640").split(",") if size)
+# Worker processes that make the thumbnails
+THUMBNAIL_WORKERS = int(os.getenv("KOKOROIKI_THUMBNAIL_WORKERS", "2"))
+
+IMAGE_URL_PREFIX = "/images/"
+# An image is named by the SHA-256 of its bytes, so its URL never points at other content: cache it for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# A thumbnail still being made (or never, without Pillow) is answered with the original for a short while
+FALLBACK_CACHE_CONTROL = "public, max-age=60"
+
+# Accepted formats, recognised from their first bytes (never from the client's Content-Type or file name)
+IMAGE_TYPES = {
+    "jpg": ("image/jpeg", "JPEG"),
+    "png": ("image/png", "PNG"),
+    "gif": ("image/gif", "GIF"),
+    "webp": ("image/webp", "WEBP"),
+}
+# OpenAPI request body of the upload routes, which read the multipart stream themselves
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object", "required": ["file"], "properties": {"file": {"type": "string", "format": "binary"}},
+        }}},
+    },
+}
+IMAGE_NAME = re.compile(r"^(?P<digest>[0-9a-f]{64})(?:-(?P<size>\d+))?\.(?P<extension>jpg|png|gif|webp)$")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def image_extension(head: bytes):
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+# Images are spread over 256 directories by the first two hex digits of their digest
+def image_path(digest: str, extension: str, size: int = None):
+    name = f"{digest}.{extension}" if size is None else f"{digest}-{size}.{extension}"
+    return os.path.join(IMAGE_DIR, digest[:2], name)
+
+
+def image_url(digest: str, extension: str, size: int = None):
+    return IMAGE_URL_PREFIX + os.path.basename(image_path(digest, extension, size))
+
+
+def image_urls(digest: str, extension: str):
+    return {
+        "url": image_url(digest, extension),
+        "thumbnails": {size: image_url(digest, extension, size) for size in THUMBNAIL_SIZES},
+    }
+
+
+# Runs in a worker process: every missing thumbnail of one stored image, each written aside and renamed into place
+def _make_thumbnails(digest: str, extension: str, sizes):
+    from PIL import Image, ImageOps
+
+    made = []
+    with Image.open(image_path(digest, extension)) as original:
+        original = ImageOps.exif_transpose(original)
+        for size in sizes:
+            path = image_path(digest, extension, size)
+            if os.path.exists(path):
+                continue
+            thumbnail = original.copy()
+            thumbnail.thumbnail((size, size))
+            if extension == "jpg" and thumbnail.mode not in ("RGB", "L"):
+                thumbnail = thumbnail.convert("RGB")
+            temporary = f"{path}.{os.getpid()}.tmp"
+            thumbnail.save(temporary, format=IMAGE_TYPES[extension][1])
+            os.replace(temporary, path)
+            made.append(size)
+    return made
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # workers come from a forkserver: forking the running server would copy locks held by its other
+            # threads (logging, malloc, SQLite) and could deadlock the child
+            _pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+        return _pool
+
+
+def _thumbnails_done(digest, future):
+    try:
+        future.result()
+    except Exception:
+        logger.exception("making the thumbnails of image %s failed", digest)
+
+
+# Queue the thumbnails of an image on the worker pool and return at once; the upload does not wait for them
+def queue_thumbnails(digest: str, extension: str):
+    if not PILLOW_INSTALLED or not THUMBNAIL_SIZES:
+        return
+    sizes = [size for size in THUMBNAIL_SIZES if not os.path.exists(image_path(digest, extension, size))]
+    if sizes:
+        future = _executor().submit(_make_thumbnails, digest, extension, sizes)
+        future.add_done_callback(lambda future: _thumbnails_done(digest, future))
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+
+# Receives the "file" part of a multipart body into a temporary file in IMAGE_DIR, hashing it on the way.
+# The parser callbacks only collect the part's bytes; they are written to disk, IMAGE_CHUNK_BYTES at a time,
+# between reads of the request body, from the threadpool
+class _Upload:
+    def __init__(self, field: str):
+        self.field = field
+        self.header_field = b""
+        self.header_value = b""
+        self.in_field = False
+        self.found = False
+        self.pending = bytearray()
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.extension = None
+        self.file = None
+        self.path = None
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_part_data": self.on_part_data,
+        }
+
+    def on_part_begin(self):
+        self.in_field = False
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        if self.header_field.lower() == b"content-disposition":
+            _, options = parse_options_header(self.header_value)
+            # only the first part with the field's name is taken
+            self.in_field = options.get(b"name") == self.field.encode() and not self.found
+            self.found = self.found or self.in_field
+        self.header_field = self.header_value = b""
+
+    def on_part_data(self, data, start, end):
+        if self.in_field:
+            self.pending += data[start:end]
+
+    def _open(self):
+        directory = os.path.join(IMAGE_DIR, ".incoming")
+        os.makedirs(directory, exist_ok=True)
+        descriptor, self.path = tempfile.mkstemp(dir=directory)
+        self.file = os.fdopen(descriptor, "wb")
+
+    def _write(self, data):
+        if self.file is None:
+            self._open()
+        self.file.write(data)
+
+    async def flush(self, final: bool = False):
+        if not self.pending or (len(self.pending) < IMAGE_CHUNK_BYTES and not final):
+            return
+        data, self.pending = bytes(self.pending), bytearray()
+        if self.extension is None:
+            self.extension = image_extension(data[:12])
+            if self.extension is None:
+                raise HTTPException(status_code=415, detail=f"only {', '.join(sorted(IMAGE_TYPES))} images can be uploaded")
+        self.size += len(data)
+        if self.size > IMAGE_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"images are limited to {IMAGE_MAX_BYTES} bytes")
+        self.sha256.update(data)
+        await run_in_threadpool(self._write, data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def discard(self):
+        self.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _store(upload: _Upload):
+    upload.close()
+    digest = upload.sha256.hexdigest()
+    path = image_path(digest, upload.extension)
+    if os.path.exists(path):
+        # the same bytes were uploaded before: keep the stored copy
+        os.remove(upload.path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(upload.path, path)
+    return digest
+
+
+# Stream the image in the multipart field `field` of the request to disk and store it under its SHA-256.
+# Returns the digest and extension; the thumbnails are queued, not waited for
+async def receive_image(request: Request, field: str = "file"):
+    if MultipartParser is None:
+        raise HTTPException(status_code=501, detail="image uploads need python-multipart")
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=415, detail="images are uploaded as multipart/form-data")
+
+    upload = _Upload(field)
+    parser = MultipartParser(options[b"boundary"], upload.callbacks())
+    received = 0
+    try:
+        async for chunk in request.stream():
+            # other fields are skipped, not stored, but they count against the limit too
+            received += len(chunk)
+            if received > IMAGE_MAX_BYTES + IMAGE_CHUNK_BYTES:
+                raise HTTPException(status_code=413, detail=f"images are limited to {IMAGE_MAX_BYTES} bytes")
+            parser.write(chunk)
+            await upload.flush()
+        parser.finalize()
+        await upload.flush(final=True)
+        if upload.size == 0:
+            raise HTTPException(status_code=400, detail=f"no image in the {field!r} field")
+        digest = await run_in_threadpool(_store, upload)
+    except BaseException:
+        upload.discard()
+        raise
+
+    queue_thumbnails(digest, upload.extension)
+    return digest, upload.extension, upload.size
+
+
+# (start, end) of a single "bytes=" range, inclusive; None to send the whole file (no range, several ranges,
+# or an If-Range that no longer matches). Raises 416 for a range outside the file
+def byte_range(request: Request, size: int, etag: str):
+    header = request.headers.get("range")
+    if header is None or not header.startswith("bytes=") or "," in header:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range != etag:
+        return None
+
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail=f"range {header!r} is outside the image", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+# FileResponse that can send a byte range of the file. With a server that offers the ASGI zero-copy send
+# extension the file descriptor is handed over (sendfile); otherwise the range is read in chunks
+class ImageResponse(FileResponse):
+    def __init__(self, path, stat_result, range=None, **kwargs):
+        super().__init__(path, stat_result=stat_result, **kwargs)
+        self.range = range
+        if range is not None:
+            start, end = range
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+            self.headers["content-length"] = str(end - start + 1)
+
+    async def __call__(self, scope, receive, send):
+        start, end = self.range or (0, self.stat_result.st_size - 1)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend", "file": file.wrapped.fileno(),
+                    "offset": start, "count": end - start + 1, "more_body": False,
+                })
+                return
+            await file.seek(start)
+            remaining = end - start + 1
+            while True:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                remaining -= len(chunk)
+                more_body = remaining > 0 and len(chunk) > 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+                if not more_body:
+                    break
+
+
+# The response for GET /images/{name}: the stored file (or the original while its thumbnail is not there),
+# a 304 for a matching If-None-Match, or one byte range of it
+async def serve_image(request: Request, name: str):
+    match = IMAGE_NAME.match(name)
+    size = match and match["size"] and int(match["size"])
+    if match is None or (size is not None and size not in THUMBNAIL_SIZES):
+        raise HTTPException(status_code=404, detail=f"image {name} not found")
+
+    digest, extension = match["digest"], match["extension"]
+    cache_control = IMMUTABLE_CACHE_CONTROL
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, image_path(digest, extension, size))
+    except FileNotFoundError:
+        if size is None:
+            raise HTTPException(status_code=404, detail=f"image {name} not found")
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, image_path(digest, extension))
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"image {name} not found")
+        size, cache_control = None, FALLBACK_CACHE_CONTROL
+
+    etag = f'"{digest}"' if size is None else f'"{digest}-{size}"'
+    headers = {
+        "Cache-Control": cache_control,
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    return ImageResponse(
+        image_path(digest, extension, size),
+        stat_result,
+        range=byte_range(request, stat_result.st_size, etag),
+        headers=headers,
+        media_type=IMAGE_TYPES[extension][0],
+        method=request.method,
+    )
@@ -0,0 +1,35 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Runs fn() every `interval` seconds on a background thread. A failing run is logged and the job carries on
+class PeriodicJob:
+    def __init__(self, name: str, interval: float, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                start = time.perf_counter()
+                result = self.fn()
+                logger.info("%s: %s in %.2fs", self.name, result, time.perf_counter() - start)
+            except Exception:
+                logger.exception("%s failed", self.name)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
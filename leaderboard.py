@@ -0,0 +1,116 @@
+import bisect
+import os
+import threading
+from sqlalchemy import func
+import models
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:  # bisect fallback: O(log n) search, but inserts shift the list
+    SortedList = None
+
+# Seconds between reconciliations of the ranking with the Closenesses table (jobs.PeriodicJob), 0 = never
+LEADERBOARD_RECONCILE_SECONDS = float(os.getenv("KOKOROIKI_LEADERBOARD_RECONCILE_SECONDS", "300"))
+# Largest k a client may ask for
+LEADERBOARD_MAX_K = 1000
+
+
+# Sorted sequence on a plain list, used when sortedcontainers is not installed
+class _BisectList:
+    def __init__(self, items=()):
+        self.items = sorted(items)
+
+    def add(self, item):
+        bisect.insort(self.items, item)
+
+    def remove(self, item):
+        del self.items[bisect.bisect_left(self.items, item)]
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __len__(self):
+        return len(self.items)
+
+
+# Trees ordered by their total close_meter. Entries are (-total, tree_id), so the highest totals come first
+# and ties go to the older tree. An update is one remove and one add on the sorted list, O(log n);
+# the top k is a slice from the front, O(log n + k)
+class Ranking:
+    def __init__(self, totals: dict = None):
+        totals = totals or {}
+        self.totals = dict(totals)
+        entries = [(-total, tree_id) for tree_id, total in self.totals.items()]
+        self.order = SortedList(entries) if SortedList is not None else _BisectList(entries)
+
+    def add(self, tree_id: int, delta: int):
+        if not delta:
+            return
+        previous = self.totals.get(tree_id)
+        if previous is not None:
+            self.order.remove((-previous, tree_id))
+        total = (previous or 0) + delta
+        # trees without closeness are not ranked, as after a load
+        if total == 0:
+            self.totals.pop(tree_id, None)
+            return
+        self.totals[tree_id] = total
+        self.order.add((-total, tree_id))
+
+    def remove(self, tree_id: int):
+        total = self.totals.pop(tree_id, None)
+        if total is not None:
+            self.order.remove((-total, tree_id))
+
+    def top(self, k: int):
+        return [(-negative_total, tree_id) for negative_total, tree_id in self.order[:k]]
+
+    def __len__(self):
+        return len(self.order)
+
+
+# The closeness leaderboard: a Ranking seeded from the database, moved by the closeness write routes
+# and rebuilt from the database now and then, which also corrects any drift (writes racing each other,
+# rows changed outside the API)
+class Leaderboard:
+    def __init__(self):
+        self.ranking = Ranking()
+        self.lock = threading.Lock()
+
+    # Summed close_meter per tree, with one GROUP BY over ix_Closenesses_tree_id
+    @staticmethod
+    def _totals(session):
+        query = (
+            session.query(models.Closeness.tree_id, func.sum(models.Closeness.close_meter))
+            .filter(models.Closeness.tree_id.isnot(None))
+            .group_by(models.Closeness.tree_id)
+        )
+        return {tree_id: total for tree_id, total in query if total}
+
+    # Seed or reconcile: the ranking is built aside and swapped in, so readers never wait on the query
+    def load(self, session):
+        ranking = Ranking(self._totals(session))
+        with self.lock:
+            self.ranking = ranking
+        return len(ranking)
+
+    # A closeness row of `tree_id` gained `delta` close_meter (negative when it lost some or was deleted)
+    def add(self, tree_id, delta):
+        if tree_id is None or not delta:
+            return
+        with self.lock:
+            self.ranking.add(tree_id, delta)
+
+    # A closeness row changed from (tree_id, close_meter) `before` to `after`
+    def move(self, before, after):
+        self.add(before[0], -(before[1] or 0))
+        self.add(after[0], after[1] or 0)
+
+    # The tree was deleted: its closeness rows no longer point to it (tree_id is set to NULL)
+    def remove(self, tree_id):
+        with self.lock:
+            self.ranking.remove(tree_id)
+
+    def top(self, k: int):
+        with self.lock:
+            return self.ranking.top(k)
@@ -0,0 +1,59 @@
+import typing
+from functools import lru_cache
+from pydantic import BaseModel
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+
+
+# Return the nested Pydantic schema behind a field annotation (AppUser, Optional[AppUser], List[AppUser]), if any
+def nested_schema(annotation):
+    if typing.get_origin(annotation) is not None:
+        for arg in typing.get_args(annotation):
+            nested = nested_schema(arg)
+            if nested is not None:
+                return nested
+        return None
+
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+
+    return None
+
+
+# Fields of a response schema that are plain table columns on the model, in schema order
+def schema_columns(model, schema):
+    table_columns = inspect(model).columns.keys()
+    return [
+        name for name, annotation in typing.get_type_hints(schema).items()
+        if name in table_columns and nested_schema(annotation) is None
+    ]
+
+
+# Walk the response schema alongside the mapper and build one loader path per nested relationship.
+# Many-to-one relationships are joined into the same SELECT, collections get one extra SELECT ... IN.
+def _loader_paths(model, schema, parent=None):
+    paths = []
+    relationships = inspect(model).relationships
+
+    for name, annotation in typing.get_type_hints(schema).items():
+        nested = nested_schema(annotation)
+        if nested is None or name not in relationships:
+            continue
+
+        relationship = relationships[name]
+        attribute = getattr(model, name)
+        if parent is None:
+            loader = selectinload(attribute) if relationship.uselist else joinedload(attribute)
+        else:
+            loader = parent.selectinload(attribute) if relationship.uselist else parent.joinedload(attribute)
+
+        # only the deepest option of a chain is needed, it loads every hop on the way
+        paths.extend(_loader_paths(relationship.mapper.class_, nested, loader) or [loader])
+
+    return paths
+
+
+# Eager-load options that let response_model serialize `model` rows without lazy loads
+@lru_cache(maxsize=None)
+def eager_options(model, schema):
+    return tuple(_loader_paths(model, schema))
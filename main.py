@@ -1,97 +1,228 @@
-from typing import List
-from fastapi import FastAPI, status, HTTPException, Depends
-from database import Base, engine, SessionLocal
-from sqlalchemy.orm import joinedload
+from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import List, Optional
+from fastapi import APIRouter, FastAPI, status, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from database import Database, Reader, AsyncSessionReader
+from settings import Settings
+from pagination import PageParams, paginate
+from fieldsets import FieldSelection
+from conditional import ConditionalGet
+from export import RESOURCES, MEDIA_TYPES, ExportFormat, iter_export
+from queries import MAX_THREAD_DEPTH, comment_thread, dashboard, family_feed
+from search import SearchScope, search
+from writes import bulk_insert, check_bulk_size, create_row, increment_like, update_row
+from buffers import LIKE_FLUSH_SECONDS, TOUCH_FLUSH_SECONDS, LikeBuffer, TouchBuffer
+from growth import GROWTH_INTERVAL_SECONDS, tick
+from jobs import PeriodicJob
+from security import dummy_hash, hash_password, hash_passwords, needs_rehash, verify_password
 from sqlalchemy.orm import Session
 import models
 import schemas
- 
-Base.metadata.create_all(engine) # Create the database
- 
-# Initialize app
-app = FastAPI(title="こころい木")
- 
-# Helper function to get database session
-def get_session():
-    session = SessionLocal()
+import migrations
+import cache
+import security
+import metrics
+import leaderboard
+import images
+
+# Routes are registered on this router; create_app builds the app around it (`app` is at the end of the file)
+router = APIRouter()
+
+# Rebuilds the closeness leaderboard from the database every KOKOROIKI_LEADERBOARD_RECONCILE_SECONDS
+def reconcile_leaderboard(db: Database, board: leaderboard.Leaderboard):
+    with db.sessions() as session:
+        return board.load(session)
+
+# Startup and shutdown of the app. The schema is only checked (one PRAGMA), unless the settings ask to create it
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    state = app.state
+    if state.settings.create_schema:
+        migrations.create_schema(state.database.engine)
+    else:
+        migrations.check_version(state.database.engine)
+
+    with state.database.sessions() as session:
+        cache.preload(session)
+        state.leaderboard.load(session)
+    for buffer in state.buffers:
+        buffer.start()
+    for job in state.jobs:
+        job.start()
+
+    try:
+        yield
+    finally:
+        for job in state.jobs:
+            job.stop()
+        for buffer in state.buffers:
+            buffer.stop() # writes what is still pending
+        security.shutdown()
+        images.shutdown()
+        await state.database.dispose()
+
+# Build an app for `settings` (the KOKOROIKI_* environment by default). Nothing here connects to the database:
+# the engines are created without a connection, and the schema is managed with `python migrations.py`.
+# Everything bound to the database (engines, sessions, buffers, jobs, leaderboard) lives on app.state,
+# so apps built with different settings (main.app and a test's) don't share any of it
+def create_app(settings: Settings = None):
+    settings = settings or Settings()
+    db = Database(settings)
+
+    app = FastAPI(title="こころい木", lifespan=lifespan)
+    state = app.state
+    state.settings = settings
+    state.database = db
+    state.leaderboard = leaderboard.Leaderboard()
+
+    # Coalesces likes into periodic batched UPDATEs when KOKOROIKI_LIKE_FLUSH_SECONDS is set
+    state.like_buffer = LikeBuffer(db.engine, LIKE_FLUSH_SECONDS) if LIKE_FLUSH_SECONDS > 0 else None
+    # Write-behind buffers for the last_login and watering touches when KOKOROIKI_TOUCH_FLUSH_SECONDS is set
+    state.last_logins = TouchBuffer(db.engine, models.AppUser, "last_login", TOUCH_FLUSH_SECONDS) if TOUCH_FLUSH_SECONDS > 0 else None
+    state.waterings = TouchBuffer(db.engine, models.Tree, "watering", TOUCH_FLUSH_SECONDS) if TOUCH_FLUSH_SECONDS > 0 else None
+    state.buffers = [buffer for buffer in (state.like_buffer, state.last_logins, state.waterings) if buffer is not None]
+
+    jobs = []
+    # Advances tree growth from watering and closeness when KOKOROIKI_GROWTH_INTERVAL_SECONDS is set
+    if GROWTH_INTERVAL_SECONDS > 0:
+        jobs.append(PeriodicJob("growth", GROWTH_INTERVAL_SECONDS, lambda: tick(db.engine)))
+    if leaderboard.LEADERBOARD_RECONCILE_SECONDS > 0:
+        jobs.append(PeriodicJob(
+            "leaderboard", leaderboard.LEADERBOARD_RECONCILE_SECONDS, lambda: reconcile_leaderboard(db, state.leaderboard),
+        ))
+    state.jobs = jobs
+
+    # Per-route latency, SQL statement count, DB time, pool wait and rows, on /metrics and in Server-Timing
+    if metrics.METRICS_ENABLED:
+        metrics.instrument(db.engine)
+        if db.async_engine is not None:
+            metrics.instrument(db.async_engine.sync_engine)
+        app.add_middleware(metrics.MetricsMiddleware)
+
+    app.include_router(router)
+    return app
+ 
+# Helper function to get a database session of the app serving the request
+def get_session(request: Request):
+    session = request.app.state.database.sessions()
     try:
         yield session
     finally:
         session.close()
 
+# Helper function to get a reader for the GET routes, backed by an AsyncSession in async mode
+async def get_reader(request: Request):
+    db = request.app.state.database
+    if db.mode == "async":
+        async with db.async_sessions() as session:
+            yield AsyncSessionReader(session)
+    else:
+        session = db.sessions()
+        try:
+            yield Reader(session)
+        finally:
+            session.close()
+
+# Rows as they will be once the touch buffer flushes, so a caller reads its own last_login / watering
+def with_touches(buffer, rows):
+    return rows if buffer is None or rows is None else buffer.overlay(rows)
+
+def touches_pending(buffer, id: int = None):
+    return buffer is not None and buffer.has_pending(id)
+
 # ===============================AppUser=============================================
-@app.get("/app-users", response_model = List[schemas.AppUser], tags=["users ユーザー"])
-def ユーザー一覧取得(session: Session = Depends(get_session)):
+@router.get("/app-users", response_model = List[schemas.AppUser], tags=["users ユーザー"])
+async def ユーザー一覧取得(request: Request, page: PageParams = Depends(), selection: FieldSelection = Depends(), conditional: ConditionalGet = Depends(), db: Reader = Depends(get_reader)):
+    last_logins = request.app.state.last_logins
  
-    users_list = (session.query(models.AppUser).all()) # get all users items
+    def load(session):
+        # answer a revalidation from a count/max(updatedAt) aggregate, before any row is loaded and serialized
+        # (not while last_login touches are buffered: the database does not show them yet)
+        if not touches_pending(last_logins) and conditional.listing(session, models.AppUser, schemas.AppUser):
+            return []
+        query = session.query(models.AppUser).options(*selection.options(models.AppUser, schemas.AppUser))
+        return with_touches(last_logins, paginate(query, models.AppUser, page))
+
+    users_list = await db.run(load) # get one page of users items
+
+    if conditional.fresh:
+        return conditional.not_modified()
  
-    return users_list 
+    return selection.render(users_list)
 
 
-@app.get("/app-users/{user_id}", response_model=schemas.AppUser, tags=["users ユーザー"])
-def 特定のユーザーの取得(user_id: int, session: Session = Depends(get_session)):
-    user = (
-        session.query(models.AppUser)
-        .options(joinedload(models.AppUser.family))  # Eager loading the 'family' relationship
-        .filter(models.AppUser.id == user_id)
-        .first()
-    )
+@router.get("/app-users/{user_id}", response_model=schemas.AppUser, tags=["users ユーザー"])
+async def 特定のユーザーの取得(user_id: int, request: Request, selection: FieldSelection = Depends(), conditional: ConditionalGet = Depends(), db: Reader = Depends(get_reader)):
+    last_logins = request.app.state.last_logins
+
+    def load(session):
+        # answer a revalidation from updatedAt alone, before the user is loaded and serialized
+        if not touches_pending(last_logins, user_id) and conditional.detail(session, models.AppUser, schemas.AppUser, user_id):
+            return None
+        user = (
+            session.query(models.AppUser)
+            .options(*selection.options(models.AppUser, schemas.AppUser))  # Eager load 'family', or only the ?fields= / ?expand= selection
+            .filter(models.AppUser.id == user_id)
+            .first()
+        )
+        return with_touches(last_logins, user)
+
+    user = await db.run(load)
+
+    if conditional.fresh:
+        return conditional.not_modified()
 
     # Check if user exists
     if not user:
         raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
 
-    return user
+    return selection.render(user)
  
-@app.post("/app-users", response_model=schemas.AppUser, status_code=status.HTTP_201_CREATED, tags=["users ユーザー"])
+@router.post("/app-users", response_model=schemas.AppUser, status_code=status.HTTP_201_CREATED, tags=["users ユーザー"])
 def ユーザーの作成(users: schemas.AppUserCreate, session: Session = Depends(get_session)):
+    # only the scrypt hash of the password is stored, computed in the password worker pool
+    users = users.copy(update={"password": hash_password(users.password)})
 
-    usersdb = models.AppUser(
-        name=users.name,
-        email=users.email,
-        password=users.password,
-        birth=users.birth,
-        age=users.age,
-        gender=users.gender,
-        quest_role=users.quest_role,
-        family_id=users.family_id,
-        last_login=datetime.today(),
-        createdAt=datetime.today(),
-        updatedAt=datetime.today(),
-        publishedAt=datetime.today()
-    )
+    usersdb = create_row(session, models.AppUser, users) # a single INSERT ... RETURNING, no refresh SELECT
  
-    session.add(usersdb)
-    session.commit()
-    session.refresh(usersdb)
-
     return usersdb
  
  
-@app.put("/app-users/{id}", response_model=schemas.AppUser, tags=["users ユーザー"])
+@router.post("/app-users/bulk", response_model=List[schemas.AppUser], status_code=status.HTTP_201_CREATED, tags=["users ユーザー"])
+def ユーザーの一括作成(users: List[schemas.AppUserCreate], session: Session = Depends(get_session)):
+    check_bulk_size(users) # before hashing, an oversized body must not cost a scrypt per item
+    hashed = hash_passwords(user.password for user in users) # every password hashed in parallel over the pool
+    users = [user.copy(update={"password": password}) for user, password in zip(users, hashed)]
+
+    usersdb_list = bulk_insert(session, models.AppUser, schemas.AppUser, users) # insert every item in one transaction
+
+    return usersdb_list
+ 
+ 
+@router.put("/app-users/{id}", response_model=schemas.AppUser, tags=["users ユーザー"])
 def 特定のユーザーの更新(id: int, users: schemas.AppUserCreate, session: Session = Depends(get_session)):
-    # Check if the users item with the given id exists
-    existing_users = session.query(models.AppUser).get(id)
+    # Update the users item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    users = users.copy(update={"password": hash_password(users.password)})
+    existing_users = update_row(session, models.AppUser, id, users.dict())
     if not existing_users:
         raise HTTPException(status_code=404, detail=f"users item with id {id} not found")
 
-    # Update the attributes of the existing_users with the values from the users parameter
-    existing_users.name = users.name
-    existing_users.email = users.email
-    existing_users.password = users.password
-    existing_users.birth = users.birth
-    existing_users.age = users.age
-    existing_users.gender = users.gender
-    existing_users.quest_role = users.quest_role
-    existing_users.family_id = users.family_id
+    return existing_users
 
-    session.commit()
-    session.refresh(existing_users)
+@router.patch("/app-users/{id}", response_model=schemas.AppUser, tags=["users ユーザー"])
+def 特定のユーザーの部分更新(id: int, users: schemas.AppUserUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    if users.password is not None:
+        users = users.copy(update={"password": hash_password(users.password)})
+    existing_users = update_row(session, models.AppUser, id, users.dict(exclude_unset=True, exclude_none=True))
+    if not existing_users:
+        raise HTTPException(status_code=404, detail=f"users item with id {id} not found")
 
     return existing_users
  
-@app.delete("/app-users/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["users ユーザー"])
+@router.delete("/app-users/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["users ユーザー"])
 def 特定のユーザーの削除(id: int, session: Session = Depends(get_session)):
  
     # get the given id
@@ -106,60 +237,93 @@ def 特定のユーザーの削除(id: int, session: Session = Depends(get_sessi
  
     return None
 
+@router.post("/login", response_model=schemas.AppUser, tags=["users ユーザー"])
+def ログイン(login: schemas.Login, request: Request, session: Session = Depends(get_session)):
+    last_logins = request.app.state.last_logins
+
+    # users are looked up by the indexed email; an unknown email still costs one verification
+    users = session.query(models.AppUser).filter(models.AppUser.email == login.email).order_by(models.AppUser.id).first()
+    if not verify_password(login.password, users.password if users else dummy_hash()) or not users:
+        raise HTTPException(status_code=401, detail="incorrect email or password")
+
+    values = {}
+    # plain text passwords from before hashing, or hashes made with an older cost, are upgraded on login
+    if needs_rehash(users.password):
+        values["password"] = hash_password(login.password)
+
+    # with the touch buffer on, last_login is written with the other logins on its next flush
+    if last_logins is not None:
+        last_logins.touch(users.id, datetime.today())
+    else:
+        values["last_login"] = datetime.today()
+
+    if values:
+        users = update_row(session, models.AppUser, users.id, values)
+
+    return with_touches(last_logins, users)
+
 # ===============================Profile=============================================
-@app.get("/profiles", response_model = List[schemas.Profile], tags=["profiles プロファイル"])
-def プロファイル一覧取得(session: Session = Depends(get_session)):
+@router.get("/profiles", response_model = List[schemas.Profile], tags=["profiles プロファイル"])
+async def プロファイル一覧取得(page: PageParams = Depends(), selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    profile_list = session.query(models.Profile).all() # get all profile items
+    def load(session):
+        query = session.query(models.Profile).options(*selection.options(models.Profile, schemas.Profile))
+        return paginate(query, models.Profile, page)
+
+    profile_list = await db.run(load) # get one page of profile items
  
-    return profile_list 
+    return selection.render(profile_list)
 
 
-@app.get("/profiles/{id}", response_model=schemas.Profile, tags=["profiles プロファイル"])
-def 特定のプロファイルの取得(id: int, session: Session = Depends(get_session)):
+@router.get("/profiles/{id}", response_model=schemas.Profile, tags=["profiles プロファイル"])
+async def 特定のプロファイルの取得(id: int, selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    profile = session.query(models.Profile).get(id) # get item with the given id
+    def load(session):
+        return session.query(models.Profile).options(*selection.options(models.Profile, schemas.Profile)).get(id)
+
+    profile = await db.run(load) # get item with the given id
  
     # check if id exists. If not, return 404 not found response
     if not profile:
         raise HTTPException(status_code=404, detail=f"profile item with id {id} not found")
  
-    return profile
+    return selection.render(profile)
  
-@app.post("/profiles", response_model=schemas.Profile, status_code=status.HTTP_201_CREATED, tags=["profiles プロファイル"])
+@router.post("/profiles", response_model=schemas.Profile, status_code=status.HTTP_201_CREATED, tags=["profiles プロファイル"])
 def プロファイルの作成(profile: schemas.ProfileCreate, session: Session = Depends(get_session)):
+
+    profiledb = create_row(session, models.Profile, profile) # a single INSERT ... RETURNING, no refresh SELECT
  
-    profiledb = models.Profile(
-        name=profile.name,
-        image=profile.image,
-        content=profile.content
-    )
+    return profiledb
  
-    session.add(profiledb)
-    session.commit()
-    session.refresh(profiledb)
  
-    return profiledb
+@router.post("/profiles/bulk", response_model=List[schemas.Profile], status_code=status.HTTP_201_CREATED, tags=["profiles プロファイル"])
+def プロファイルの一括作成(profile: List[schemas.ProfileCreate], session: Session = Depends(get_session)):
+
+    profiledb_list = bulk_insert(session, models.Profile, schemas.Profile, profile) # insert every item in one transaction
+
+    return profiledb_list
  
  
-@app.put("/profiles/{id}", response_model=schemas.Profile, tags=["profiles プロファイル"])
+@router.put("/profiles/{id}", response_model=schemas.Profile, tags=["profiles プロファイル"])
 def 特定のプロファイルの更新(id: int, profile: schemas.ProfileCreate, session: Session = Depends(get_session)):
-    # Check if the profile item with the given id exists
-    existing_profile = session.query(models.Profile).get(id)
+    # Update the profile item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    existing_profile = update_row(session, models.Profile, id, profile.dict())
     if not existing_profile:
         raise HTTPException(status_code=404, detail=f"profile item with id {id} not found")
 
-    # Update the attributes of the existing_profile with the values from the profile parameter
-    existing_profile.name = profile.name
-    existing_profile.image = profile.image
-    existing_profile.content = profile.content
+    return existing_profile
 
-    session.commit()
-    session.refresh(existing_profile)
+@router.patch("/profiles/{id}", response_model=schemas.Profile, tags=["profiles プロファイル"])
+def 特定のプロファイルの部分更新(id: int, profile: schemas.ProfileUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    existing_profile = update_row(session, models.Profile, id, profile.dict(exclude_unset=True, exclude_none=True))
+    if not existing_profile:
+        raise HTTPException(status_code=404, detail=f"profile item with id {id} not found")
 
     return existing_profile
  
-@app.delete("/profiles/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["profiles プロファイル"])
+@router.delete("/profiles/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["profiles プロファイル"])
 def 特定のプロファイルの削除(id: int, session: Session = Depends(get_session)):
  
     # get the given id
@@ -175,57 +339,79 @@ def 特定のプロファイルの削除(id: int, session: Session = Depends(get
     return None
 
 # ===============================Family=============================================
-@app.get("/families", response_model = List[schemas.Family], tags=["families 家族"])
-def 家族一覧取得(session: Session = Depends(get_session)):
+@router.get("/families", response_model = List[schemas.Family], tags=["families 家族"])
+async def 家族一覧取得(page: PageParams = Depends(), selection: FieldSelection = Depends(), conditional: ConditionalGet = Depends(), db: Reader = Depends(get_reader)):
  
-    family_list = session.query(models.Family).all() # get all family items
+    def load(session):
+        # answer a revalidation from a count/max(updatedAt) aggregate, before any row is loaded and serialized
+        if conditional.listing(session, models.Family, schemas.Family):
+            return []
+        query = session.query(models.Family).options(*selection.options(models.Family, schemas.Family))
+        return paginate(query, models.Family, page)
+
+    family_list = await db.run(load) # get one page of family items
+
+    if conditional.fresh:
+        return conditional.not_modified()
  
-    return family_list 
+    return selection.render(family_list)
 
 
-@app.get("/families/{id}", response_model=schemas.Family, tags=["families 家族"])
-def 特定の家族の取得(id: int, session: Session = Depends(get_session)):
+@router.get("/families/{id}", response_model=schemas.Family, tags=["families 家族"])
+async def 特定の家族の取得(id: int, selection: FieldSelection = Depends(), conditional: ConditionalGet = Depends(), db: Reader = Depends(get_reader)):
  
-    family = session.query(models.Family).get(id) # get item with the given id
+    def load(session):
+        # answer a revalidation from updatedAt alone, before the family is loaded and serialized
+        if conditional.detail(session, models.Family, schemas.Family, id):
+            return None
+        return session.query(models.Family).options(*selection.options(models.Family, schemas.Family)).get(id)
+
+    family = await db.run(load) # get item with the given id
+
+    if conditional.fresh:
+        return conditional.not_modified()
  
     # check if id exists. If not, return 404 not found response
     if not family:
         raise HTTPException(status_code=404, detail=f"family item with id {id} not found")
  
-    return family
+    return selection.render(family)
  
-@app.post("/families", response_model=schemas.Family, status_code=status.HTTP_201_CREATED, tags=["families 家族"])
+@router.post("/families", response_model=schemas.Family, status_code=status.HTTP_201_CREATED, tags=["families 家族"])
 def 家族の作成(family: schemas.FamilyCreate, session: Session = Depends(get_session)):
+
+    familydb = create_row(session, models.Family, family) # a single INSERT ... RETURNING, no refresh SELECT
  
-    familydb = models.Family(
-        name=family.name,
-        createdAt=datetime.today(),
-        updatedAt=datetime.today()
-    )
+    return familydb
  
-    session.add(familydb)
-    session.commit()
-    session.refresh(familydb)
  
-    return familydb
+@router.post("/families/bulk", response_model=List[schemas.Family], status_code=status.HTTP_201_CREATED, tags=["families 家族"])
+def 家族の一括作成(family: List[schemas.FamilyCreate], session: Session = Depends(get_session)):
+
+    familydb_list = bulk_insert(session, models.Family, schemas.Family, family) # insert every item in one transaction
+
+    return familydb_list
  
  
-@app.put("/families/{id}", response_model=schemas.Family, tags=["families 家族"])
+@router.put("/families/{id}", response_model=schemas.Family, tags=["families 家族"])
 def 特定の家族の更新(id: int, family: schemas.FamilyCreate, session: Session = Depends(get_session)):
-    # Check if the family item with the given id exists
-    existing_family = session.query(models.Family).get(id)
+    # Update the family item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    existing_family = update_row(session, models.Family, id, family.dict())
     if not existing_family:
         raise HTTPException(status_code=404, detail=f"family item with id {id} not found")
 
-    # Update the attributes of the existing_family with the values from the family parameter
-    existing_family.name=family.name
+    return existing_family
 
-    session.commit()
-    session.refresh(existing_family)
+@router.patch("/families/{id}", response_model=schemas.Family, tags=["families 家族"])
+def 特定の家族の部分更新(id: int, family: schemas.FamilyUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    existing_family = update_row(session, models.Family, id, family.dict(exclude_unset=True, exclude_none=True))
+    if not existing_family:
+        raise HTTPException(status_code=404, detail=f"family item with id {id} not found")
 
     return existing_family
  
-@app.delete("/families/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["families 家族"])
+@router.delete("/families/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["families 家族"])
 def 特定の家族の削除(id: int, session: Session = Depends(get_session)):
  
     # get the given id
@@ -240,67 +426,90 @@ def 特定の家族の削除(id: int, session: Session = Depends(get_session)):
  
     return None
 
+@router.get("/families/{id}/feed", response_model=List[schemas.FeedPost], tags=["families 家族"])
+async def 家族のフィード取得(id: int, page: PageParams = Depends(), db: Reader = Depends(get_reader)):
+
+    def load(session):
+        return family_feed(session, id, page)
+
+    feed = await db.run(load) # newest posts of the family's members, with author and comment count
+
+    return feed
+
 # ===============================Post=============================================
-@app.get("/posts", response_model = List[schemas.Post], tags=["posts"])
-def 投稿一覧取得(session: Session = Depends(get_session)):
+@router.get("/posts", response_model = List[schemas.Post], tags=["posts"])
+async def 投稿一覧取得(page: PageParams = Depends(), selection: FieldSelection = Depends(), conditional: ConditionalGet = Depends(), db: Reader = Depends(get_reader)):
  
-    post_list = session.query(models.Post).all() # get all post items
+    def load(session):
+        # answer a revalidation from a count/max(updatedAt) aggregate, before any row is loaded and serialized
+        if conditional.listing(session, models.Post, schemas.Post):
+            return []
+        query = session.query(models.Post).options(*selection.options(models.Post, schemas.Post))
+        return paginate(query, models.Post, page)
+
+    post_list = await db.run(load) # get one page of post items
+
+    if conditional.fresh:
+        return conditional.not_modified()
  
-    return post_list 
+    return selection.render(post_list)
 
 
-@app.get("/posts/{id}", response_model=schemas.Post, tags=["posts"])
-def 特定の投稿の取得(id: int, session: Session = Depends(get_session)):
+@router.get("/posts/{id}", response_model=schemas.Post, tags=["posts"])
+async def 特定の投稿の取得(id: int, selection: FieldSelection = Depends(), conditional: ConditionalGet = Depends(), db: Reader = Depends(get_reader)):
  
-    post = session.query(models.Post).get(id) # get item with the given id
+    def load(session):
+        # answer a revalidation from updatedAt alone, before the post is loaded and serialized
+        if conditional.detail(session, models.Post, schemas.Post, id):
+            return None
+        return session.query(models.Post).options(*selection.options(models.Post, schemas.Post)).get(id)
+
+    post = await db.run(load) # get item with the given id
+
+    if conditional.fresh:
+        return conditional.not_modified()
  
     # check if id exists. If not, return 404 not found response
     if not post:
         raise HTTPException(status_code=404, detail=f"post item with id {id} not found")
  
-    return post
+    return selection.render(post)
  
-@app.post("/posts", response_model=schemas.Post, status_code=status.HTTP_201_CREATED, tags=["posts"])
+@router.post("/posts", response_model=schemas.Post, status_code=status.HTTP_201_CREATED, tags=["posts"])
 def 投稿の作成(post: schemas.PostCreate, session: Session = Depends(get_session)):
+
+    postdb = create_row(session, models.Post, post) # a single INSERT ... RETURNING, no refresh SELECT
  
-    postdb = models.Post(
-        user_id=post.user_id,
-        kids=post.kids,
-        content=post.content,
-        image_url=post.image_url,
-        like=post.like,
-        createdAt=datetime.today(),
-        updatedAt=datetime.today(),
-        publishedAt=datetime.today()
-    )
+    return postdb
  
-    session.add(postdb)
-    session.commit()
-    session.refresh(postdb)
  
-    return postdb
+@router.post("/posts/bulk", response_model=List[schemas.Post], status_code=status.HTTP_201_CREATED, tags=["posts"])
+def 投稿の一括作成(post: List[schemas.PostCreate], session: Session = Depends(get_session)):
+
+    postdb_list = bulk_insert(session, models.Post, schemas.Post, post) # insert every item in one transaction
+
+    return postdb_list
  
  
-@app.put("/posts/{id}", response_model=schemas.Post, tags=["posts"])
+@router.put("/posts/{id}", response_model=schemas.Post, tags=["posts"])
 def 特定の投稿の更新(id: int, post: schemas.PostCreate, session: Session = Depends(get_session)):
-    # Check if the post item with the given id exists
-    existing_post = session.query(models.Post).get(id)
+    # Update the Post item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    existing_post = update_row(session, models.Post, id, post.dict())
     if not existing_post:
         raise HTTPException(status_code=404, detail=f"Post item with id {id} not found")
 
-    # Update the attributes of the existing_post with the values from the post parameter
-    existing_post.user_id = post.user_id
-    existing_post.kids = post.kids
-    existing_post.content = post.content
-    existing_post.image_url = post.image_url
-    existing_post.like = post.like
+    return existing_post
 
-    session.commit()
-    session.refresh(existing_post)
+@router.patch("/posts/{id}", response_model=schemas.Post, tags=["posts"])
+def 特定の投稿の部分更新(id: int, post: schemas.PostUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    existing_post = update_row(session, models.Post, id, post.dict(exclude_unset=True, exclude_none=True))
+    if not existing_post:
+        raise HTTPException(status_code=404, detail=f"Post item with id {id} not found")
 
     return existing_post
  
-@app.delete("/posts/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["posts"])
+@router.delete("/posts/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["posts"])
 def 特定の投稿の削除(id: int, session: Session = Depends(get_session)):
  
     # get the given id
@@ -316,63 +525,93 @@ def 特定の投稿の削除(id: int, session: Session = Depends(get_session)):
     return None
 
 
+
+@router.post("/posts/{id}/like", response_model=schemas.PostLike, tags=["posts"])
+def 投稿にいいね(id: int, request: Request, response: Response, session: Session = Depends(get_session)):
+    return change_like(id, 1, request, response, session)
+
+
+@router.post("/posts/{id}/unlike", response_model=schemas.PostLike, tags=["posts"])
+def 投稿のいいね取り消し(id: int, request: Request, response: Response, session: Session = Depends(get_session)):
+    return change_like(id, -1, request, response, session)
+
+
+def change_like(id: int, n: int, request: Request, response: Response, session: Session):
+    like_buffer = request.app.state.like_buffer
+    # With the like buffer on, the change is merged with other likes and written on the next flush
+    if like_buffer is not None:
+        like_buffer.add(id, n)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return schemas.PostLike(id=id)
+
+    like = increment_like(session, id, n)
+    if like is None:
+        raise HTTPException(status_code=404, detail=f"post item with id {id} not found")
+
+    return schemas.PostLike(id=id, like=like)
+
 # ===============================Comment=============================================
-@app.get("/comments", response_model = List[schemas.Comment], tags=["comments"])
-def コメント一覧取得(session: Session = Depends(get_session)):
+@router.get("/comments", response_model = List[schemas.Comment], tags=["comments"])
+async def コメント一覧取得(page: PageParams = Depends(), selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    comment_list = session.query(models.Comment).all() # get all Comment items
+    def load(session):
+        query = session.query(models.Comment).options(*selection.options(models.Comment, schemas.Comment))
+        return paginate(query, models.Comment, page)
+
+    comment_list = await db.run(load) # get one page of Comment items
  
-    return comment_list 
+    return selection.render(comment_list)
 
 
-@app.get("/comments/{id}", response_model=schemas.Comment, tags=["comments"])
-def 特定のコメントの取得(id: int, session: Session = Depends(get_session)):
+@router.get("/comments/{id}", response_model=schemas.Comment, tags=["comments"])
+async def 特定のコメントの取得(id: int, selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    comment = session.query(models.Comment).get(id) # get item with the given id
+    def load(session):
+        return session.query(models.Comment).options(*selection.options(models.Comment, schemas.Comment)).get(id)
+
+    comment = await db.run(load) # get item with the given id
  
     # check if id exists. If not, return 404 not found response
     if not comment:
         raise HTTPException(status_code=404, detail=f"comment item with id {id} not found")
  
-    return comment
+    return selection.render(comment)
  
-@app.post("/comments", response_model=schemas.Comment, status_code=status.HTTP_201_CREATED, tags=["comments"])
+@router.post("/comments", response_model=schemas.Comment, status_code=status.HTTP_201_CREATED, tags=["comments"])
 def コメントの作成(comment: schemas.CommentCreate, session: Session = Depends(get_session)):
+
+    commentdb = create_row(session, models.Comment, comment) # a single INSERT ... RETURNING, no refresh SELECT
  
-    commentdb = models.Comment(
-        parent_id = comment.parent_id,
-        post_id = comment.post_id,
-        user_id = comment.user_id,
-        content = comment.content,
-        createdAt= datetime.today()
-    )
+    return commentdb
  
-    session.add(commentdb)
-    session.commit()
-    session.refresh(commentdb)
  
-    return commentdb
+@router.post("/comments/bulk", response_model=List[schemas.Comment], status_code=status.HTTP_201_CREATED, tags=["comments"])
+def コメントの一括作成(comment: List[schemas.CommentCreate], session: Session = Depends(get_session)):
+
+    commentdb_list = bulk_insert(session, models.Comment, schemas.Comment, comment) # insert every item in one transaction
+
+    return commentdb_list
  
  
-@app.put("/comments/{id}", response_model=schemas.Comment, tags=["comments"])
+@router.put("/comments/{id}", response_model=schemas.Comment, tags=["comments"])
 def 特定のコメントの更新(id: int, comment: schemas.CommentCreate, session: Session = Depends(get_session)):
-    # Check if the comment item with the given id exists
-    existing_comment = session.query(models.Comment).get(id)
+    # Update the Comment item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    existing_comment = update_row(session, models.Comment, id, comment.dict())
     if not existing_comment:
         raise HTTPException(status_code=404, detail=f"Comment item with id {id} not found")
 
-    # Update the attributes of the existing_comment with the values from the comment parameter
-    existing_comment.parent_id = comment.parent_id
-    existing_comment.post_id = comment.post_id
-    existing_comment.user_id = comment.user_id
-    existing_comment.content = comment.content
+    return existing_comment
 
-    session.commit()
-    session.refresh(existing_comment)
+@router.patch("/comments/{id}", response_model=schemas.Comment, tags=["comments"])
+def 特定のコメントの部分更新(id: int, comment: schemas.CommentUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    existing_comment = update_row(session, models.Comment, id, comment.dict(exclude_unset=True, exclude_none=True))
+    if not existing_comment:
+        raise HTTPException(status_code=404, detail=f"Comment item with id {id} not found")
 
     return existing_comment
  
-@app.delete("/comments/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["comments"])
+@router.delete("/comments/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["comments"])
 def 特定のコメントの削除(id: int, session: Session = Depends(get_session)):
  
     # get the given id
@@ -387,61 +626,100 @@ def 特定のコメントの削除(id: int, session: Session = Depends(get_sessi
  
     return None
 
+
+@router.get("/posts/{id}/comments/tree", response_model=List[schemas.CommentNode], tags=["comments"])
+async def 投稿のコメントツリー取得(id: int, max_depth: Optional[int] = Query(None, ge=0, le=MAX_THREAD_DEPTH), page: PageParams = Depends(), db: Reader = Depends(get_reader)):
+
+    def load(session):
+        return comment_thread(session, id, page, max_depth)
+
+    thread = await db.run(load) # one page of top-level comments with their replies
+
+    return thread
+
  
 # ===============================Tree=============================================
-@app.get("/trees", response_model = List[schemas.Tree], tags=["trees"])
-def 木一覧取得(session: Session = Depends(get_session)):
+@router.get("/trees", response_model = List[schemas.Tree], tags=["trees"])
+async def 木一覧取得(request: Request, page: PageParams = Depends(), selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
+    waterings = request.app.state.waterings
  
-    tree_list = session.query(models.Tree).all() # get all Tree items
+    def load(session):
+        query = session.query(models.Tree).options(*selection.options(models.Tree, schemas.Tree))
+        return with_touches(waterings, paginate(query, models.Tree, page))
+
+    tree_list = await db.run(load) # get one page of Tree items
  
-    return tree_list 
+    return selection.render(tree_list)
 
 
-@app.get("/trees/{id}", response_model=schemas.Tree, tags=["trees"])
-def 特定の木の取得(id: int, session: Session = Depends(get_session)):
+@router.get("/trees/{id}", response_model=schemas.Tree, tags=["trees"])
+async def 特定の木の取得(id: int, request: Request, selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
+    waterings = request.app.state.waterings
  
-    tree = session.query(models.Tree).get(id) # get item with the given id
+    def load(session):
+        return with_touches(waterings, session.query(models.Tree).options(*selection.options(models.Tree, schemas.Tree)).get(id))
+
+    tree = await db.run(load) # get item with the given id
  
     # check if id exists. If not, return 404 not found response
     if not tree:
         raise HTTPException(status_code=404, detail=f"tree item with id {id} not found")
  
-    return tree
+    return selection.render(tree)
  
-@app.post("/trees", response_model=schemas.Tree, status_code=status.HTTP_201_CREATED, tags=["trees"])
+@router.post("/trees", response_model=schemas.Tree, status_code=status.HTTP_201_CREATED, tags=["trees"])
 def 木の作成(tree: schemas.TreeCreate, session: Session = Depends(get_session)):
+
+    treedb = create_row(session, models.Tree, tree) # a single INSERT ... RETURNING, no refresh SELECT
  
-    treedb = models.Tree(
-        growth_stage = tree.growth_stage,
-        quest = tree.quest,
-        watering = datetime.today()
-    )
+    return treedb
  
-    session.add(treedb)
-    session.commit()
-    session.refresh(treedb)
  
-    return treedb
+@router.post("/trees/bulk", response_model=List[schemas.Tree], status_code=status.HTTP_201_CREATED, tags=["trees"])
+def 木の一括作成(tree: List[schemas.TreeCreate], session: Session = Depends(get_session)):
+
+    treedb_list = bulk_insert(session, models.Tree, schemas.Tree, tree) # insert every item in one transaction
+
+    return treedb_list
  
  
-@app.put("/trees/{id}", response_model=schemas.Tree, tags=["trees"])
+@router.put("/trees/{id}", response_model=schemas.Tree, tags=["trees"])
 def 特定の木の更新(id: int, tree: schemas.TreeCreate, session: Session = Depends(get_session)):
-    # Check if the tree item with the given id exists
-    existing_tree = session.query(models.Tree).get(id)
+    # Update the Tree item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    existing_tree = update_row(session, models.Tree, id, tree.dict())
     if not existing_tree:
         raise HTTPException(status_code=404, detail=f"Tree item with id {id} not found")
 
-    # Update the attributes of the existing_tree with the values from the tree parameter
-    existing_tree.growth_stage = tree.growth_stage
-    existing_tree.quest = tree.quest
+    return existing_tree
 
-    session.commit()
-    session.refresh(existing_tree)
+@router.patch("/trees/{id}", response_model=schemas.Tree, tags=["trees"])
+def 特定の木の部分更新(id: int, tree: schemas.TreeUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    existing_tree = update_row(session, models.Tree, id, tree.dict(exclude_unset=True, exclude_none=True))
+    if not existing_tree:
+        raise HTTPException(status_code=404, detail=f"Tree item with id {id} not found")
 
     return existing_tree
  
-@app.delete("/trees/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["trees"])
-def 特定の木の削除(id: int, session: Session = Depends(get_session)):
+@router.post("/trees/{id}/water", response_model=schemas.Tree, tags=["trees"])
+def 木の水やり(id: int, request: Request, session: Session = Depends(get_session)):
+    waterings = request.app.state.waterings
+
+    # With the touch buffer on, the tree is only read here and watering is written on the next flush
+    if waterings is not None:
+        tree = session.get(models.Tree, id)
+        if tree:
+            waterings.touch(id, datetime.today())
+    else:
+        tree = update_row(session, models.Tree, id, {"watering": datetime.today()})
+
+    if not tree:
+        raise HTTPException(status_code=404, detail=f"tree item with id {id} not found")
+
+    return with_touches(waterings, tree)
+
+@router.delete("/trees/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["trees"])
+def 特定の木の削除(id: int, request: Request, session: Session = Depends(get_session)):
  
     # get the given id
     tree = session.query(models.Tree).get(id)
@@ -450,6 +728,7 @@ def 特定の木の削除(id: int, session: Session = Depends(get_session)):
     if tree:
         session.delete(tree)
         session.commit()
+        request.app.state.leaderboard.remove(id) # its closeness rows are no longer ranked
     else:
         raise HTTPException(status_code=404, detail=f"tree item with id {id} not found")
  
@@ -457,57 +736,72 @@ def 特定の木の削除(id: int, session: Session = Depends(get_session)):
 
  
 # ===============================QuestType=============================================
-@app.get("/quest_types", response_model = List[schemas.QuestType], tags=["quest_types"])
-def クエストタイプ一覧取得(session: Session = Depends(get_session)):
+@router.get("/quest_types", response_model = List[schemas.QuestType], tags=["quest_types"])
+async def クエストタイプ一覧取得(page: PageParams = Depends(), selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    questtype_list = session.query(models.QuestType).all() # get all QuestType items
+    def load(session):
+        # the table is small and read-mostly, so it is served from the reference cache unless a sparse selection is asked for
+        if not selection.active:
+            return cache.quest_types.page(session, page)
+        query = session.query(models.QuestType).options(*selection.options(models.QuestType, schemas.QuestType))
+        return paginate(query, models.QuestType, page)
+
+    questtype_list = await db.run(load) # get one page of QuestType items
  
-    return questtype_list 
+    return selection.render(questtype_list, models.QuestType, schemas.QuestType)
 
 
-@app.get("/quest_types/{id}", response_model=schemas.QuestType, tags=["quest_types"])
-def 特定のクエストタイプの取得(id: int, session: Session = Depends(get_session)):
+@router.get("/quest_types/{id}", response_model=schemas.QuestType, tags=["quest_types"])
+async def 特定のクエストタイプの取得(id: int, selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    questtype = session.query(models.QuestType).get(id) # get item with the given id
+    def load(session):
+        if not selection.active:
+            return cache.quest_types.get(session, id)
+        return session.query(models.QuestType).options(*selection.options(models.QuestType, schemas.QuestType)).get(id)
+
+    questtype = await db.run(load) # get item with the given id
  
     # check if id exists. If not, return 404 not found response
     if not questtype:
         raise HTTPException(status_code=404, detail=f"questtype item with id {id} not found")
  
-    return questtype
+    return selection.render(questtype, models.QuestType, schemas.QuestType)
  
-@app.post("/quest_types", response_model=schemas.QuestType, status_code=status.HTTP_201_CREATED, tags=["quest_types"])
+@router.post("/quest_types", response_model=schemas.QuestType, status_code=status.HTTP_201_CREATED, tags=["quest_types"])
 def クエストタイプの作成(questtype: schemas.QuestTypeCreate, session: Session = Depends(get_session)):
- 
-    questtypedb = models.QuestType(
-        kinds = questtype.kinds,
-        online = questtype.online
-    )
 
-    session.add(questtypedb)
-    session.commit()
-    session.refresh(questtypedb)
+    questtypedb = create_row(session, models.QuestType, questtype) # a single INSERT ... RETURNING, no refresh SELECT
  
     return questtypedb
  
  
-@app.put("/quest_types/{id}", response_model=schemas.QuestType, tags=["quest_types"])
+@router.post("/quest_types/bulk", response_model=List[schemas.QuestType], status_code=status.HTTP_201_CREATED, tags=["quest_types"])
+def クエストタイプの一括作成(questtype: List[schemas.QuestTypeCreate], session: Session = Depends(get_session)):
+
+    questtypedb_list = bulk_insert(session, models.QuestType, schemas.QuestType, questtype) # insert every item in one transaction
+
+    return questtypedb_list
+ 
+ 
+@router.put("/quest_types/{id}", response_model=schemas.QuestType, tags=["quest_types"])
 def 特定のクエストタイプの更新(id: int, questtype: schemas.QuestTypeCreate, session: Session = Depends(get_session)):
-    # Check if the questtype item with the given id exists
-    existing_tree = session.query(models.QuestType).get(id)
+    # Update the QuestType item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    existing_tree = update_row(session, models.QuestType, id, questtype.dict())
     if not existing_tree:
         raise HTTPException(status_code=404, detail=f"QuestType item with id {id} not found")
 
-    # Update the attributes of the existing_tree with the values from the questtype parameter
-    existing_tree.kinds = questtype.kinds
-    existing_tree.online = questtype.online
+    return existing_tree
 
-    session.commit()
-    session.refresh(existing_tree)
+@router.patch("/quest_types/{id}", response_model=schemas.QuestType, tags=["quest_types"])
+def 特定のクエストタイプの部分更新(id: int, questtype: schemas.QuestTypeUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    existing_tree = update_row(session, models.QuestType, id, questtype.dict(exclude_unset=True, exclude_none=True))
+    if not existing_tree:
+        raise HTTPException(status_code=404, detail=f"QuestType item with id {id} not found")
 
     return existing_tree
  
-@app.delete("/quest_types/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["quest_types"])
+@router.delete("/quest_types/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["quest_types"])
 def 特定のクエストタイプの削除(id: int, session: Session = Depends(get_session)):
  
     # get the given id
@@ -524,55 +818,72 @@ def 特定のクエストタイプの削除(id: int, session: Session = Depends(
 
  
 # ===============================Reward=============================================
-@app.get("/rewards", response_model = List[schemas.Reward], tags=["rewards"])
-def 褒美一覧取得(session: Session = Depends(get_session)):
+@router.get("/rewards", response_model = List[schemas.Reward], tags=["rewards"])
+async def 褒美一覧取得(page: PageParams = Depends(), selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    reward_list = session.query(models.Reward).all() # get all Reward items
+    def load(session):
+        # the table is small and read-mostly, so it is served from the reference cache unless a sparse selection is asked for
+        if not selection.active:
+            return cache.rewards.page(session, page)
+        query = session.query(models.Reward).options(*selection.options(models.Reward, schemas.Reward))
+        return paginate(query, models.Reward, page)
+
+    reward_list = await db.run(load) # get one page of Reward items
  
-    return reward_list 
+    return selection.render(reward_list, models.Reward, schemas.Reward)
 
 
-@app.get("/rewards/{id}", response_model=schemas.Reward, tags=["rewards"])
-def 特定の褒美の取得(id: int, session: Session = Depends(get_session)):
+@router.get("/rewards/{id}", response_model=schemas.Reward, tags=["rewards"])
+async def 特定の褒美の取得(id: int, selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    reward = session.query(models.Reward).get(id) # get item with the given id
+    def load(session):
+        if not selection.active:
+            return cache.rewards.get(session, id)
+        return session.query(models.Reward).options(*selection.options(models.Reward, schemas.Reward)).get(id)
+
+    reward = await db.run(load) # get item with the given id
  
     # check if id exists. If not, return 404 not found response
     if not reward:
         raise HTTPException(status_code=404, detail=f"reward item with id {id} not found")
  
-    return reward
+    return selection.render(reward, models.Reward, schemas.Reward)
  
-@app.post("/rewards", response_model=schemas.Reward, status_code=status.HTTP_201_CREATED, tags=["rewards"])
+@router.post("/rewards", response_model=schemas.Reward, status_code=status.HTTP_201_CREATED, tags=["rewards"])
 def 褒美の作成(reward: schemas.RewardCreate, session: Session = Depends(get_session)):
- 
-    rewarddb = models.Reward(
-        content = reward.content
-    )
 
-    session.add(rewarddb)
-    session.commit()
-    session.refresh(rewarddb)
+    rewarddb = create_row(session, models.Reward, reward) # a single INSERT ... RETURNING, no refresh SELECT
  
     return rewarddb
  
  
-@app.put("/rewards/{id}", response_model=schemas.Reward, tags=["rewards"])
+@router.post("/rewards/bulk", response_model=List[schemas.Reward], status_code=status.HTTP_201_CREATED, tags=["rewards"])
+def 褒美の一括作成(reward: List[schemas.RewardCreate], session: Session = Depends(get_session)):
+
+    rewarddb_list = bulk_insert(session, models.Reward, schemas.Reward, reward) # insert every item in one transaction
+
+    return rewarddb_list
+ 
+ 
+@router.put("/rewards/{id}", response_model=schemas.Reward, tags=["rewards"])
 def 特定の褒美の更新(id: int, reward: schemas.RewardCreate, session: Session = Depends(get_session)):
-    # Check if the reward item with the given id exists
-    existing_reward = session.query(models.Reward).get(id)
+    # Update the Reward item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    existing_reward = update_row(session, models.Reward, id, reward.dict())
     if not existing_reward:
         raise HTTPException(status_code=404, detail=f"Reward item with id {id} not found")
 
-    # Update the attributes of the existing_reward with the values from the reward parameter
-    existing_reward.content = reward.content
+    return existing_reward
 
-    session.commit()
-    session.refresh(existing_reward)
+@router.patch("/rewards/{id}", response_model=schemas.Reward, tags=["rewards"])
+def 特定の褒美の部分更新(id: int, reward: schemas.RewardUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    existing_reward = update_row(session, models.Reward, id, reward.dict(exclude_unset=True, exclude_none=True))
+    if not existing_reward:
+        raise HTTPException(status_code=404, detail=f"Reward item with id {id} not found")
 
     return existing_reward
  
-@app.delete("/rewards/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["rewards"])
+@router.delete("/rewards/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["rewards"])
 def 特定の褒美の削除(id: int, session: Session = Depends(get_session)):
  
     # get the given id
@@ -589,59 +900,74 @@ def 特定の褒美の削除(id: int, session: Session = Depends(get_session)):
 
  
 # ===============================Quest=============================================
-@app.get("/quests", response_model = List[schemas.Quest], tags=["quests"])
-def クエスト一覧取得(session: Session = Depends(get_session)):
+@router.get("/quests", response_model = List[schemas.Quest], tags=["quests"])
+async def クエスト一覧取得(page: PageParams = Depends(), selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    quests_list = session.query(models.Quest).all() # get all quests items
+    def load(session):
+        # each quest's QuestType comes from the reference cache instead of a join
+        if not selection.active:
+            quests_list = paginate(session.query(models.Quest), models.Quest, page)
+            return cache.quests_with_types(session, quests_list)
+        query = session.query(models.Quest).options(*selection.options(models.Quest, schemas.Quest))
+        return paginate(query, models.Quest, page)
+
+    quests_list = await db.run(load) # get one page of quests items
  
-    return quests_list 
+    return selection.render(quests_list, models.Quest, schemas.Quest)
 
 
-@app.get("/quests/{id}", response_model=schemas.Quest, tags=["quests"])
-def 特定のクエストの取得(id: int, session: Session = Depends(get_session)):
+@router.get("/quests/{id}", response_model=schemas.Quest, tags=["quests"])
+async def 特定のクエストの取得(id: int, selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    quests = session.query(models.Quest).get(id) # get item with the given id
+    def load(session):
+        if not selection.active:
+            quests = session.query(models.Quest).get(id)
+            return None if quests is None else cache.quest_with_type(session, quests)
+        return session.query(models.Quest).options(*selection.options(models.Quest, schemas.Quest)).get(id)
+
+    quests = await db.run(load) # get item with the given id
  
     # check if id exists. If not, return 404 not found response
     if not quests:
         raise HTTPException(status_code=404, detail=f"quests item with id {id} not found")
  
-    return quests
+    return selection.render(quests, models.Quest, schemas.Quest)
  
-@app.post("/quests", response_model=schemas.Quest, status_code=status.HTTP_201_CREATED, tags=["quests"])
+@router.post("/quests", response_model=schemas.Quest, status_code=status.HTTP_201_CREATED, tags=["quests"])
 def クエストの作成(quests: schemas.QuestCreate, session: Session = Depends(get_session)):
+
+    questsdb = create_row(session, models.Quest, quests) # a single INSERT ... RETURNING, no refresh SELECT
  
-    questsdb = models.Quest(
-        content=quests.content,
-        quest_kinds=quests.quest_kinds,
-        completed=quests.completed
-    )
+    return questsdb
  
-    session.add(questsdb)
-    session.commit()
-    session.refresh(questsdb)
  
-    return questsdb
+@router.post("/quests/bulk", response_model=List[schemas.Quest], status_code=status.HTTP_201_CREATED, tags=["quests"])
+def クエストの一括作成(quests: List[schemas.QuestCreate], session: Session = Depends(get_session)):
+
+    questsdb_list = bulk_insert(session, models.Quest, schemas.Quest, quests) # insert every item in one transaction
+
+    return questsdb_list
  
  
-@app.put("/quests/{id}", response_model=schemas.Quest, tags=["quests"])
+@router.put("/quests/{id}", response_model=schemas.Quest, tags=["quests"])
 def 特定のクエストの更新(id: int, quests: schemas.QuestCreate, session: Session = Depends(get_session)):
-    # Check if the quests item with the given id exists
-    existing_quests = session.query(models.Quest).get(id)
+    # Update the quests item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    existing_quests = update_row(session, models.Quest, id, quests.dict())
     if not existing_quests:
         raise HTTPException(status_code=404, detail=f"quests item with id {id} not found")
 
-    # Update the attributes of the existing_quests with the values from the quests parameter
-    existing_quests.content=quests.content
-    existing_quests.quest_kinds=quests.quest_kinds
-    existing_quests.completed=quests.completed
+    return existing_quests
 
-    session.commit()
-    session.refresh(existing_quests)
+@router.patch("/quests/{id}", response_model=schemas.Quest, tags=["quests"])
+def 特定のクエストの部分更新(id: int, quests: schemas.QuestUpdate, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    existing_quests = update_row(session, models.Quest, id, quests.dict(exclude_unset=True, exclude_none=True))
+    if not existing_quests:
+        raise HTTPException(status_code=404, detail=f"quests item with id {id} not found")
 
     return existing_quests
  
-@app.delete("/quests/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["quests"])
+@router.delete("/quests/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["quests"])
 def 特定のクエストの削除(id: int, session: Session = Depends(get_session)):
  
     # get the given id
@@ -657,57 +983,74 @@ def 特定のクエストの削除(id: int, session: Session = Depends(get_sessi
     return None
  
 # ===============================Closeness=============================================
-@app.get("/closeness", response_model = List[schemas.Closeness], tags=["closeness"])
-def Closenessの一覧取得(session: Session = Depends(get_session)):
+@router.get("/closeness", response_model = List[schemas.Closeness], tags=["closeness"])
+async def Closenessの一覧取得(page: PageParams = Depends(), selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
  
-    closeness_list = (session.query(models.Closeness).all()) # get all closeness items
+    def load(session):
+        query = session.query(models.Closeness).options(*selection.options(models.Closeness, schemas.Closeness))
+        return paginate(query, models.Closeness, page)
+
+    closeness_list = await db.run(load) # get one page of closeness items
  
-    return closeness_list 
+    return selection.render(closeness_list)
+
 
+@router.get("/closeness/{id}", response_model=schemas.Closeness, tags=["closeness"])
+async def 特定のClosenessを取得(id: int, selection: FieldSelection = Depends(), db: Reader = Depends(get_reader)):
+    def load(session):
+        return session.query(models.Closeness).options(*selection.options(models.Closeness, schemas.Closeness)).get(id)
 
-@app.get("/closeness/{id}", response_model=schemas.Closeness, tags=["closeness"])
-def 特定のClosenessを取得(id: int, session: Session = Depends(get_session)):
-    close = session.query(models.Closeness).get(id) # get item with the given id
+    close = await db.run(load) # get item with the given id
 
     # Check if close exists
     if not close:
         raise HTTPException(status_code=404, detail=f"Closeness with id {id} not found")
 
-    return close
+    return selection.render(close)
  
-@app.post("/closeness", response_model=schemas.Closeness, status_code=status.HTTP_201_CREATED, tags=["closeness"])
-def Closenessの作成(closeness: schemas.ClosenessCreate, session: Session = Depends(get_session)):
+@router.post("/closeness", response_model=schemas.Closeness, status_code=status.HTTP_201_CREATED, tags=["closeness"])
+def Closenessの作成(closeness: schemas.ClosenessCreate, request: Request, session: Session = Depends(get_session)):
 
-    closenessdb = models.Closeness(
-        tree_id=closeness.tree_id,
-        close_meter=closeness.close_meter,
-    )
+    closenessdb = create_row(session, models.Closeness, closeness) # a single INSERT ... RETURNING, no refresh SELECT
+    request.app.state.leaderboard.add(closenessdb.tree_id, closenessdb.close_meter)
  
-    session.add(closenessdb)
-    session.commit()
-    session.refresh(closenessdb)
-
     return closenessdb
  
  
-@app.put("/closeness/{id}", response_model=schemas.Closeness, tags=["closeness"])
-def 特定のClosenessの更新(id: int, closeness: schemas.ClosenessCreate, session: Session = Depends(get_session)):
-    # Check if the closeness item with the given id exists
-    existing_closeness = session.query(models.Closeness).get(id)
+@router.post("/closeness/bulk", response_model=List[schemas.Closeness], status_code=status.HTTP_201_CREATED, tags=["closeness"])
+def Closenessの一括作成(closeness: List[schemas.ClosenessCreate], request: Request, session: Session = Depends(get_session)):
+
+    closenessdb_list = bulk_insert(session, models.Closeness, schemas.Closeness, closeness) # insert every item in one transaction
+    for closenessdb in closenessdb_list:
+        request.app.state.leaderboard.add(closenessdb.tree_id, closenessdb.close_meter)
+
+    return closenessdb_list
+ 
+ 
+@router.put("/closeness/{id}", response_model=schemas.Closeness, tags=["closeness"])
+def 特定のClosenessの更新(id: int, closeness: schemas.ClosenessCreate, request: Request, session: Session = Depends(get_session)):
+    # Update the Closeness item with the given id in a single UPDATE ... RETURNING, an empty result means it does not exist
+    before = closeness_before_update(session, id)
+    existing_closeness = update_row(session, models.Closeness, id, closeness.dict())
     if not existing_closeness:
         raise HTTPException(status_code=404, detail=f"Closeness item with id {id} not found")
+    request.app.state.leaderboard.move(before, (existing_closeness.tree_id, existing_closeness.close_meter))
 
-    # Update the attributes of the existing_closeness with the values from the closeness parameter
-    existing_closeness.tree_id = closeness.tree_id
-    existing_closeness.close_meter = closeness.close_meter
+    return existing_closeness
 
-    session.commit()
-    session.refresh(existing_closeness)
+@router.patch("/closeness/{id}", response_model=schemas.Closeness, tags=["closeness"])
+def 特定のClosenessの部分更新(id: int, closeness: schemas.ClosenessUpdate, request: Request, session: Session = Depends(get_session)):
+    # Only the fields sent in the request are written
+    before = closeness_before_update(session, id)
+    existing_closeness = update_row(session, models.Closeness, id, closeness.dict(exclude_unset=True, exclude_none=True))
+    if not existing_closeness:
+        raise HTTPException(status_code=404, detail=f"Closeness item with id {id} not found")
+    request.app.state.leaderboard.move(before, (existing_closeness.tree_id, existing_closeness.close_meter))
 
     return existing_closeness
  
-@app.delete("/closeness/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["closeness"])
-def 特定のClosenessの削除(id: int, session: Session = Depends(get_session)):
+@router.delete("/closeness/{id}", status_code=status.HTTP_204_NO_CONTENT, tags=["closeness"])
+def 特定のClosenessの削除(id: int, request: Request, session: Session = Depends(get_session)):
  
     # get the given id
     closeness = session.query(models.Closeness).get(id)
@@ -716,7 +1059,132 @@ def 特定のClosenessの削除(id: int, session: Session = Depends(get_session)
     if closeness:
         session.delete(closeness)
         session.commit()
+        request.app.state.leaderboard.add(closeness.tree_id, -(closeness.close_meter or 0))
     else:
         raise HTTPException(status_code=404, detail=f"closeness item with id {id} not found")
  
-    return None
\ No newline at end of file
+    return None
+
+# (tree_id, close_meter) of a closeness row before it is updated, as plain values the UPDATE does not refresh
+def closeness_before_update(session, id: int):
+    return session.query(models.Closeness.tree_id, models.Closeness.close_meter).filter(models.Closeness.id == id).first() or (None, 0)
+
+@router.get("/leaderboard", response_model=List[schemas.LeaderboardEntry], tags=["closeness"])
+async def 親密度ランキング取得(request: Request, k: int = Query(10, ge=1, le=leaderboard.LEADERBOARD_MAX_K)):
+
+    # served from the in-memory ranking, no query
+    top = request.app.state.leaderboard.top(k)
+
+    return [schemas.LeaderboardEntry(rank=rank, tree_id=tree_id, close_meter=total) for rank, (total, tree_id) in enumerate(top, 1)]
+
+
+# ===============================Dashboard=============================================
+@router.get("/dashboard", response_model=schemas.Dashboard, tags=["dashboard"])
+async def ダッシュボード取得(page: PageParams = Depends(), db: Reader = Depends(get_reader)):
+
+    def load(session):
+        return dashboard(session, page)
+
+    summary = await db.run(load) # one page of trees with their closeness, quest types with their completion counts
+
+    return summary
+
+
+# ===============================Image=============================================
+# The stored image and the URLs of its thumbnails, for Post.image_url / Profile.image
+def image_upload(digest: str, extension: str, size: int):
+    return schemas.ImageUpload(digest=digest, content_type=images.IMAGE_TYPES[extension][0], size=size, **images.image_urls(digest, extension))
+
+@router.post("/images", response_model=schemas.ImageUpload, status_code=status.HTTP_201_CREATED, tags=["images 画像"], openapi_extra=images.UPLOAD_OPENAPI)
+async def 画像のアップロード(request: Request):
+
+    digest, extension, size = await images.receive_image(request) # streamed to disk in chunks, stored once per distinct content
+
+    return image_upload(digest, extension, size)
+
+
+@router.get("/images/{name}", tags=["images 画像"])
+async def 画像取得(name: str, request: Request):
+    return await images.serve_image(request, name) # immutable cache headers, Range requests answered with 206
+
+
+@router.put("/posts/{id}/image", response_model=schemas.Post, tags=["posts"], openapi_extra=images.UPLOAD_OPENAPI)
+async def 投稿画像の更新(id: int, request: Request, session: Session = Depends(get_session)):
+
+    digest, extension, _ = await images.receive_image(request)
+
+    def update(session):
+        # image_url now points at the stored image; the response is built here, where the session may load post.user
+        post = update_row(session, models.Post, id, {"image_url": images.image_url(digest, extension)})
+        return post and schemas.Post.from_orm(post)
+
+    post = await run_in_threadpool(update, session)
+    if not post:
+        raise HTTPException(status_code=404, detail=f"Post item with id {id} not found")
+
+    return post
+
+
+@router.put("/profiles/{id}/image", response_model=schemas.Profile, tags=["profiles プロファイル"], openapi_extra=images.UPLOAD_OPENAPI)
+async def プロファイル画像の更新(id: int, request: Request, session: Session = Depends(get_session)):
+
+    digest, extension, _ = await images.receive_image(request)
+
+    def update(session):
+        profile = update_row(session, models.Profile, id, {"image": images.image_url(digest, extension)})
+        return profile and schemas.Profile.from_orm(profile)
+
+    profile = await run_in_threadpool(update, session)
+    if not profile:
+        raise HTTPException(status_code=404, detail=f"profile item with id {id} not found")
+
+    return profile
+
+
+# ===============================Search=============================================
+@router.get("/search", response_model=List[schemas.SearchHit], tags=["search"])
+async def 検索(
+    q: str = Query(..., min_length=1, description="words that must all appear in the post or comment, at least one of 3 characters or more"),
+    scope: SearchScope = SearchScope.all,
+    family_id: Optional[int] = Query(None, description="only posts of this family's members and their comments"),
+    page: PageParams = Depends(),
+    db: Reader = Depends(get_reader),
+):
+
+    def load(session):
+        return search(session, q, page, scope, family_id)
+
+    hits = await db.run(load) # best ranked first, from the FTS5 indexes
+
+    return hits
+
+
+# ===============================Export=============================================
+@router.get("/export/{resource}", tags=["export"])
+def データのエクスポート(resource: str, request: Request, format: ExportFormat = ExportFormat.ndjson):
+
+    # check if the resource exists. If not, return 404 not found response
+    if resource not in RESOURCES:
+        raise HTTPException(status_code=404, detail=f"resource {resource} not found")
+
+    # rows are read from the cursor in batches and written out as they arrive
+    return StreamingResponse(
+        iter_export(request.app.state.database.sessions, resource, format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{resource}.{format.value}"'},
+    )
+
+
+# ===============================Monitoring=============================================
+@router.get("/cache/stats", tags=["monitoring"])
+def キャッシュ統計取得():
+    return cache.stats() # hits, misses and size of each reference cache
+
+
+@router.get("/metrics", response_class=PlainTextResponse, tags=["monitoring"])
+def メトリクス取得():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4") # Prometheus text format
+
+
+# The app served by `uvicorn main:app`, configured from the environment
+app = create_app()
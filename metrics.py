@@ -0,0 +1,246 @@
+import os
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+from database import CHECKOUT_WAIT_LISTENERS
+
+# Record per-route request and database metrics, served on /metrics
+METRICS_ENABLED = os.getenv("KOKOROIKI_METRICS", "1") == "1"
+# Also send each request's database time in a Server-Timing response header
+SERVER_TIMING = os.getenv("KOKOROIKI_SERVER_TIMING", "1") == "1"
+
+# Histogram buckets: request latency in seconds, SQL statements per request
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 25, 50, 100)
+
+
+# Database work done while serving one request
+class RequestStats:
+    __slots__ = ("statements", "db_seconds", "pool_wait_seconds", "rows")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.rows = 0
+
+    def server_timing(self, total_seconds: float):
+        return (
+            f'db;dur={self.db_seconds * 1000:.2f};desc="{self.statements} queries", '
+            f"pool;dur={self.pool_wait_seconds * 1000:.2f}, "
+            f"total;dur={total_seconds * 1000:.2f}"
+        )
+
+
+# The stats of the request being served. The threadpool (sync routes and dependencies) and run_sync
+# (async mode) both run in a copy of the request's context, so they add to the same object
+_current = ContextVar("request_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None or not conn.info.get("query_start"):
+        return
+    stats.db_seconds += time.perf_counter() - conn.info["query_start"].pop()
+    stats.statements += 1
+    # rows written; rows returned are counted as they are fetched (SQLite reports no rowcount for SELECT)
+    if cursor.description is None and cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+
+
+# DBAPI cursor that adds the rows it hands out to the current request's stats, whatever reads them:
+# ORM queries (one row per result row, eager-joined objects included), Core selects, RETURNING, streamed exports
+class _CountingCursor:
+    __slots__ = ("cursor",)
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    @staticmethod
+    def _count(rows):
+        stats = _current.get()
+        if stats is not None:
+            stats.rows += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self._count((row,))
+        return row
+
+    def fetchmany(self, *args):
+        return self._count(self.cursor.fetchmany(*args))
+
+    def fetchall(self):
+        return self._count(self.cursor.fetchall())
+
+
+# Mixed into the dialect's execution context: every statement of the engine runs on a counting cursor
+class _CountingContext:
+    def create_cursor(self):
+        return _CountingCursor(super().create_cursor())
+
+
+def _record_pool_wait(seconds: float):
+    stats = _current.get()
+    if stats is not None:
+        stats.pool_wait_seconds += seconds
+
+
+# Time and count every statement run on `bind`, and the rows it returns
+def instrument(bind):
+    event.listen(bind, "before_cursor_execute", _before_cursor_execute)
+    event.listen(bind, "after_cursor_execute", _after_cursor_execute)
+    # execution_ctx_cls and create_cursor() are the dialect's documented extension points; the dialect belongs to this engine
+    dialect = bind.dialect
+    if not issubclass(dialect.execution_ctx_cls, _CountingContext):
+        base = dialect.execution_ctx_cls
+        dialect.execution_ctx_cls = type(f"Counting{base.__name__}", (_CountingContext, base), {})
+
+
+CHECKOUT_WAIT_LISTENERS.append(_record_pool_wait)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.responses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.rows = 0
+
+
+# Totals per (method, route template), so /posts/1 and /posts/2 are one series
+class Registry:
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def observe(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        with self.lock:
+            metrics = self.routes.get((method, route))
+            if metrics is None:
+                metrics = self.routes[(method, route)] = RouteMetrics()
+            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+            metrics.latency.observe(seconds)
+            metrics.statements.observe(stats.statements)
+            metrics.db_seconds += stats.db_seconds
+            metrics.pool_wait_seconds += stats.pool_wait_seconds
+            metrics.rows += stats.rows
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+
+    # Prometheus text exposition format 0.0.4
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, labels, values: Histogram):
+            for bound, count in zip(values.buckets, values.counts):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {values.count}')
+            lines.append(f"{name}_sum{{{labels}}} {values.sum}")
+            lines.append(f"{name}_count{{{labels}}} {values.count}")
+
+        with self.lock:
+            routes = sorted((key, metrics) for key, metrics in self.routes.items())
+            series = [(f'method="{_escape(method)}",route="{_escape(route)}"', metrics) for (method, route), metrics in routes]
+
+            family("kokoroiki_http_requests_total", "counter", "Requests served, by status code.")
+            for labels, metrics in series:
+                for status, count in sorted(metrics.responses.items()):
+                    lines.append(f'kokoroiki_http_requests_total{{{labels},status="{status}"}} {count}')
+
+            family("kokoroiki_http_request_duration_seconds", "histogram", "Time to serve a request.")
+            for labels, metrics in series:
+                histogram("kokoroiki_http_request_duration_seconds", labels, metrics.latency)
+
+            family("kokoroiki_db_statements_per_request", "histogram", "SQL statements executed per request.")
+            for labels, metrics in series:
+                histogram("kokoroiki_db_statements_per_request", labels, metrics.statements)
+
+            for name, attribute, help_text in (
+                ("kokoroiki_db_seconds_total", "db_seconds", "Time spent executing SQL statements."),
+                ("kokoroiki_db_pool_wait_seconds_total", "pool_wait_seconds", "Time spent waiting for a pooled connection."),
+                ("kokoroiki_db_rows_total", "rows", "Rows returned by SQL statements, plus rows written by statements without RETURNING."),
+            ):
+                family(name, "counter", help_text)
+                for labels, metrics in series:
+                    lines.append(f"{name}{{{labels}}} {getattr(metrics, attribute)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+
+# ASGI middleware: collects the RequestStats of each HTTP request, adds the Server-Timing header
+# and records the request under its route template once the response is sent
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    MutableHeaders(scope=message).append("Server-Timing", stats.server_timing(time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            # the router puts the matched route in the scope
+            route = scope.get("route")
+            registry.observe(scope["method"], getattr(route, "path", "unmatched"), status, time.perf_counter() - start, stats)
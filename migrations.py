@@ -0,0 +1,94 @@
+from sqlalchemy import text
+from conditional import create_table_versions
+from database import Base
+from search import create_search_tables
+import models  # noqa: F401  (registers the tables on Base.metadata)
+
+# Schema versions are tracked in SQLite's PRAGMA user_version.
+# create_all only creates missing tables, so anything added to an existing table
+# (indexes, columns, virtual tables) is shipped as a numbered migration below.
+# The schema is created and upgraded by running this module (`python migrations.py`), once per deploy,
+# not by every app process at startup.
+
+
+# Create the named indexes declared on the models, skipping the ones that already exist
+def create_indexes(*names):
+    def migrate(connection):
+        indexes = {index.name: index for table in Base.metadata.sorted_tables for index in table.indexes}
+        for name in names:
+            indexes[name].create(connection, checkfirst=True)
+    return migrate
+
+
+# (version, description, migrate(connection)), in order
+MIGRATIONS = [
+    (1, "foreign key, lookup and createdAt indexes", create_indexes(
+        "ix_Users_email",
+        "ix_Users_family_id",
+        "ix_Users_createdAt",
+        "ix_Families_createdAt",
+        "ix_Posts_createdAt",
+        "ix_Posts_user_id_createdAt",
+        "ix_Comments_parent_id",
+        "ix_Comments_user_id",
+        "ix_Comments_createdAt",
+        "ix_Comments_post_id_createdAt",
+        "ix_Quests_quest_kinds",
+        "ix_Closenesses_tree_id",
+    )),
+    (2, "updatedAt indexes for conditional GET", create_indexes(
+        "ix_Users_updatedAt",
+        "ix_Families_updatedAt",
+        "ix_Posts_updatedAt",
+    )),
+    (3, "FTS5 search tables over Posts.content and Comments.content", create_search_tables),
+    (4, "trigger-kept change counters for the list validators of conditional GET", create_table_versions),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+# Apply every migration newer than the database, each one in its own transaction
+def upgrade(bind):
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        with bind.begin() as connection:
+            if current_version(connection) >= version:
+                continue
+            migrate(connection)
+            connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+        applied.append((version, description))
+
+    return applied
+
+
+# Missing tables, then every pending migration
+def create_schema(bind):
+    Base.metadata.create_all(bind)
+    return upgrade(bind)
+
+
+# Startup check of an app whose schema is managed with this module: one PRAGMA, no reflection, no DDL
+def check_version(bind):
+    with bind.connect() as connection:
+        version = current_version(connection)
+    if version < LATEST_VERSION:
+        raise RuntimeError(
+            f"database schema is at version {version}, the app needs {LATEST_VERSION}: run `python migrations.py`"
+        )
+    return version
+
+
+if __name__ == "__main__":
+    from database import Database
+    from settings import Settings
+
+    engine = Database(Settings()).engine
+    for version, description in create_schema(engine):
+        print(f"applied {version}: {description}")
+    with engine.connect() as connection:
+        print(f"schema version {current_version(connection)}")
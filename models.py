@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.schema import ForeignKey
 from database import Base
@@ -9,16 +9,16 @@ class AppUser(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
-    email = Column(String)
+    email = Column(String, index=True)
     password = Column(String)
     birth = Column(Integer)
     age = Column(Integer)
     gender = Column(String)
     quest_role = Column(Boolean)
-    family_id = Column(Integer, ForeignKey('Families.id'))
+    family_id = Column(Integer, ForeignKey('Families.id'), index=True)
     last_login = Column(DateTime)
-    createdAt = Column(DateTime)
-    updatedAt = Column(DateTime)
+    createdAt = Column(DateTime, index=True)
+    updatedAt = Column(DateTime, index=True)
     publishedAt = Column(DateTime)
 
     family = relationship("Family", back_populates="user")
@@ -40,8 +40,8 @@ class Family(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
-    createdAt = Column(DateTime)
-    updatedAt = Column(DateTime)
+    createdAt = Column(DateTime, index=True)
+    updatedAt = Column(DateTime, index=True)
 
     user = relationship("AppUser", back_populates="family")
 
@@ -55,22 +55,28 @@ class Post(Base):
     content = Column(String)
     image_url = Column(String)
     like = Column(Integer)
-    createdAt = Column(DateTime)
-    updatedAt = Column(DateTime)
+    createdAt = Column(DateTime, index=True)
+    updatedAt = Column(DateTime, index=True)
     publishedAt = Column(DateTime)
 
     user = relationship("AppUser", back_populates="post")
 
+    # a user's posts in chronological order, also serves lookups on user_id alone
+    __table_args__ = (Index("ix_Posts_user_id_createdAt", "user_id", "createdAt"),)
+
 # Comment
 class Comment(Base):
     __tablename__ = 'Comments'
 
     id = Column(Integer, primary_key=True)
-    parent_id = Column(Integer)
+    parent_id = Column(Integer, index=True)
     post_id = Column(Integer)
-    user_id = Column(Integer)
+    user_id = Column(Integer, index=True)
     content = Column(String)
-    createdAt = Column(DateTime)
+    createdAt = Column(DateTime, index=True)
+
+    # a post's comments in chronological order, also serves lookups on post_id alone
+    __table_args__ = (Index("ix_Comments_post_id_createdAt", "post_id", "createdAt"),)
 
 
 # Tree
@@ -108,7 +114,7 @@ class Quest(Base):
 
     id = Column(Integer, primary_key=True)
     content = Column(Integer)
-    quest_kinds = Column(Integer, ForeignKey('QuestTypes.id'))
+    quest_kinds = Column(Integer, ForeignKey('QuestTypes.id'), index=True)
     completed = Column(Boolean)
 
     quests = relationship("QuestType", back_populates="quest_id")
@@ -118,7 +124,7 @@ class Closeness(Base):
     __tablename__ = 'Closenesses'
 
     id = Column(Integer, primary_key=True)
-    tree_id = Column(Integer, ForeignKey('Trees.id'))
+    tree_id = Column(Integer, ForeignKey('Trees.id'), index=True)
     close_meter = Column(Integer)
 
     tree = relationship("Tree", back_populates="closeness")
@@ -0,0 +1,84 @@
+import base64
+import binascii
+import json
+from typing import Optional
+from fastapi import HTTPException, Query, Request, Response
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+# Encode the position of the last row of a page into an opaque cursor string.
+# Pages not ordered by id alone (search results by rank) add the other sort keys as `position`
+def encode_cursor(last_id: int, **position) -> str:
+    raw = json.dumps({"id": last_id, **position}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+# Decode every key of a cursor produced by encode_cursor. Tampered cursors are a client error
+def decode_position(cursor: str) -> dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        last_id = position["id"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail=f"invalid cursor {cursor!r}")
+
+    if not isinstance(last_id, int):
+        raise HTTPException(status_code=400, detail=f"invalid cursor {cursor!r}")
+
+    return position
+
+
+# Decode a cursor produced by encode_cursor into the id of the last row
+def decode_cursor(cursor: str) -> int:
+    return decode_position(cursor)["id"]
+
+
+# Query parameters shared by every list endpoint (?limit=&after=)
+class PageParams:
+    def __init__(
+        self,
+        request: Request,
+        response: Response,
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        after: Optional[str] = Query(None, description="cursor returned in the previous page's Link header"),
+    ):
+        self.request = request
+        self.response = response
+        self.limit = limit
+        self.after = after
+
+    # id of the last row already returned, or None on the first page
+    @property
+    def after_id(self):
+        return None if self.after is None else decode_cursor(self.after)
+
+    # every key of the cursor, or None on the first page
+    @property
+    def position(self):
+        return None if self.after is None else decode_position(self.after)
+
+    # Advertise the next page, which starts after the row with id last_id
+    def set_next(self, last_id: int, **position):
+        next_cursor = encode_cursor(last_id, **position)
+        next_url = self.request.url.include_query_params(after=next_cursor, limit=self.limit)
+        self.response.headers["Link"] = f'<{next_url}>; rel="next"'
+        self.response.headers["X-Next-Cursor"] = next_cursor
+
+
+# Keyset pagination on the primary key.
+# Ids are assigned in insertion order, so ordering by id is also ordering by createdAt,
+# and "id > last_id" lets the database seek straight to the page instead of scanning with OFFSET.
+def paginate(query, model, page: PageParams):
+    if page.after is not None:
+        query = query.filter(model.id > page.after_id)
+
+    # fetch one extra row to know whether there is a next page
+    rows = query.order_by(model.id).limit(page.limit + 1).all()
+
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        page.set_next(rows[-1].id)
+
+    return rows
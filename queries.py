@@ -0,0 +1,140 @@
+from sqlalchemy import case, func, literal, or_, select
+from sqlalchemy.orm import aliased
+from loaders import schema_columns
+from pagination import PageParams, paginate
+import models
+import schemas
+
+# Replies deeper than this are not returned. It also stops the recursion
+# if an edited parent_id ever makes a cycle.
+MAX_THREAD_DEPTH = 100
+
+
+# Every comment of a post as nested threads, read with a single WITH RECURSIVE query.
+# A page is a number of top-level comments (parent_id NULL or 0), each returned with its replies
+# up to max_depth levels below it.
+def comment_thread(session, post_id: int, page: PageParams, max_depth: int = None):
+    max_depth = MAX_THREAD_DEPTH if max_depth is None else min(max_depth, MAX_THREAD_DEPTH)
+
+    roots = select(models.Comment.id).where(
+        models.Comment.post_id == post_id,
+        or_(models.Comment.parent_id.is_(None), models.Comment.parent_id == 0),
+    )
+    if page.after is not None:
+        roots = roots.where(models.Comment.id > page.after_id)
+    # one extra root tells whether there is a next page
+    roots = roots.order_by(models.Comment.id).limit(page.limit + 1)
+
+    thread = (
+        select(models.Comment.id, models.Comment.parent_id, literal(0).label("depth"))
+        .where(models.Comment.id.in_(roots.scalar_subquery()))
+        .cte("thread", recursive=True)
+    )
+    reply = aliased(models.Comment)
+    thread = thread.union_all(
+        select(reply.id, reply.parent_id, thread.c.depth + 1)
+        .where(reply.parent_id == thread.c.id, reply.post_id == post_id, thread.c.depth < max_depth)
+    )
+
+    rows = (
+        session.query(models.Comment, thread.c.depth)
+        .join(thread, models.Comment.id == thread.c.id)
+        .order_by(thread.c.depth, models.Comment.id)
+        .all()
+    )
+
+    # parents come before their replies (ordered by depth), so one pass links every node
+    columns = schema_columns(models.Comment, schemas.Comment)
+    nodes = {}
+    threads = []
+    for comment, depth in rows:
+        node = {name: getattr(comment, name) for name in columns}
+        node["depth"] = depth
+        node["children"] = []
+        nodes[comment.id] = node
+        if depth == 0:
+            threads.append(node)
+        else:
+            nodes[comment.parent_id]["children"].append(node)
+
+    if len(threads) > page.limit:
+        threads = threads[:page.limit]
+        page.set_next(threads[-1]["id"])
+
+    return threads
+
+
+# One page of a family's posts, newest first, each with its author and number of comments, in a single query.
+# The family's users come from ix_Users_family_id and their posts from ix_Posts_user_id_createdAt; the comment
+# count is a correlated COUNT on ix_Comments_post_id_createdAt, evaluated only for the rows of the page.
+def family_feed(session, family_id: int, page: PageParams):
+    post_columns = schema_columns(models.Post, schemas.FeedPost)
+    author_columns = schema_columns(models.AppUser, schemas.FeedAuthor)
+    comment_count = (
+        select(func.count(models.Comment.id))
+        .where(models.Comment.post_id == models.Post.id)
+        .correlate(models.Post)
+        .scalar_subquery()
+    )
+
+    query = (
+        session.query(
+            *[getattr(models.Post, name) for name in post_columns],
+            *[getattr(models.AppUser, name).label(f"author_{name}") for name in author_columns],
+            comment_count.label("comment_count"),
+        )
+        .join(models.AppUser, models.Post.user_id == models.AppUser.id)
+        .filter(models.AppUser.family_id == family_id)
+    )
+    if page.after is not None:
+        query = query.filter(models.Post.id < page.after_id)
+    rows = query.order_by(models.Post.id.desc()).limit(page.limit + 1).all()
+
+    feed = []
+    for row in rows[:page.limit]:
+        values = row._mapping
+        post = {name: values[name] for name in post_columns}
+        post["author"] = {name: values[f"author_{name}"] for name in author_columns}
+        post["comment_count"] = values["comment_count"]
+        feed.append(post)
+
+    if len(rows) > page.limit:
+        page.set_next(feed[-1]["id"])
+
+    return feed
+
+
+# One page of trees with their summed closeness, and the quest types with their completion counts, each
+# aggregated with a GROUP BY over the indexed foreign key (ix_Closenesses_tree_id, ix_Quests_quest_kinds).
+# Trees are keyset-paged like every list (the page is a range of Tree.id, so only its closeness rows are read);
+# quest types are a small reference table and come whole on every page
+def dashboard(session, page: PageParams):
+    trees = (
+        session.query(
+            models.Tree.id,
+            models.Tree.growth_stage,
+            models.Tree.quest,
+            models.Tree.watering,
+            func.coalesce(func.sum(models.Closeness.close_meter), 0).label("close_meter"),
+            func.count(models.Closeness.id).label("closeness_count"),
+        )
+        .outerjoin(models.Closeness, models.Closeness.tree_id == models.Tree.id)
+        .group_by(models.Tree.id)
+    )
+    quest_types = (
+        session.query(
+            models.QuestType.id,
+            models.QuestType.kinds,
+            models.QuestType.online,
+            func.count(models.Quest.id).label("quest_count"),
+            func.coalesce(func.sum(case((models.Quest.completed == True, 1), else_=0)), 0).label("completed_count"),  # noqa: E712
+        )
+        .outerjoin(models.Quest, models.Quest.quest_kinds == models.QuestType.id)
+        .group_by(models.QuestType.id)
+        .order_by(models.QuestType.id)
+    )
+
+    return {
+        "trees": [dict(row._mapping) for row in paginate(trees, models.Tree, page)],
+        "quest_types": [dict(row._mapping) for row in quest_types],
+    }
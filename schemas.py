@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 
 # =================================Family===========================================
@@ -8,6 +8,10 @@ class FamilyCreate(BaseModel):
     name: str
     users: int
 
+# Partial update Family Schema (Pydantic Model)
+class FamilyUpdate(BaseModel):
+    name: Optional[str] = None
+
 # Complete Family Schema (Pydantic Model)
 class Family(BaseModel):
     id: int
@@ -30,12 +34,27 @@ class AppUserCreate(BaseModel):
     quest_role: bool
     family_id: int
 
-# Complete appUser Schema (Pydantic Model)
+# Partial update appUser Schema (Pydantic Model)
+class AppUserUpdate(BaseModel):
+    name: Optional[str] = None
+    email: Optional[str] = None
+    password: Optional[str] = None
+    birth: Optional[int] = None
+    age: Optional[int] = None
+    gender: Optional[str] = None
+    quest_role: Optional[bool] = None
+    family_id: Optional[int] = None
+
+# Login Schema (Pydantic Model)
+class Login(BaseModel):
+    email: str
+    password: str
+
+# Complete appUser Schema, without the password (Pydantic Model)
 class AppUser(BaseModel):
     id: int
     name: str
     email: str
-    password: str
     birth: int
     age: int
     gender: str
@@ -57,6 +76,12 @@ class ProfileCreate(BaseModel):
     image: str
     content: str
 
+# Partial update Profile Schema (Pydantic Model)
+class ProfileUpdate(BaseModel):
+    name: Optional[str] = None
+    image: Optional[str] = None
+    content: Optional[str] = None
+
 # Complete Profile Schema (Pydantic Model)
 class Profile(BaseModel):
     id: int
@@ -77,6 +102,14 @@ class PostCreate(BaseModel):
     image_url: str
     like: int
 
+# Partial update Post Schema (Pydantic Model)
+class PostUpdate(BaseModel):
+    user_id: Optional[int] = None
+    kids: Optional[int] = None
+    content: Optional[str] = None
+    image_url: Optional[str] = None
+    like: Optional[int] = None
+
 # Complete Post Schema (Pydantic Model)
 class Post(BaseModel):
     id: int
@@ -92,7 +125,32 @@ class Post(BaseModel):
 
     class Config:
         orm_mode = True
+
+# Like count of a Post (Pydantic Model). like is None while the change waits in the like buffer
+class PostLike(BaseModel):
+    id: int
+    like: Optional[int] = None
         
+# Author of a feed post, without the account fields (Pydantic Model)
+class FeedAuthor(BaseModel):
+    id: int
+    name: str
+    family_id: int
+
+# Post of a family feed with its author and comment count (Pydantic Model)
+class FeedPost(BaseModel):
+    id: int
+    user_id: int
+    kids: int
+    content: str
+    image_url: str
+    like: int
+    createdAt: datetime = None
+    updatedAt: datetime = None
+    publishedAt: datetime = None
+    author: FeedAuthor
+    comment_count: int
+
 # =================================Comment===========================================
 # Create Comment Schema (Pydantic Model)
 class CommentCreate(BaseModel):
@@ -101,6 +159,13 @@ class CommentCreate(BaseModel):
     user_id: int
     content: str
 
+# Partial update Comment Schema (Pydantic Model)
+class CommentUpdate(BaseModel):
+    parent_id: Optional[int] = None
+    post_id: Optional[int] = None
+    user_id: Optional[int] = None
+    content: Optional[str] = None
+
 # Complete Comment Schema (Pydantic Model)
 class Comment(BaseModel):
     id: int
@@ -113,6 +178,13 @@ class Comment(BaseModel):
     class Config:
         orm_mode = True
 
+# Comment with its replies (Pydantic Model)
+class CommentNode(Comment):
+    depth: int
+    children: List["CommentNode"] = []
+
+CommentNode.update_forward_refs()
+
 
 # =================================Tree===========================================
 # Create Tree Schema (Pydantic Model)
@@ -120,6 +192,11 @@ class TreeCreate(BaseModel):
     growth_stage: int
     quest: int
 
+# Partial update Tree Schema (Pydantic Model)
+class TreeUpdate(BaseModel):
+    growth_stage: Optional[int] = None
+    quest: Optional[int] = None
+
 # Complete Tree Schema (Pydantic Model)
 class Tree(BaseModel):
     id: int
@@ -137,6 +214,11 @@ class QuestTypeCreate(BaseModel):
     kinds: str
     online: bool
 
+# Partial update QuestType Schema (Pydantic Model)
+class QuestTypeUpdate(BaseModel):
+    kinds: Optional[str] = None
+    online: Optional[bool] = None
+
 # Complete QuestType Schema (Pydantic Model)
 class QuestType(BaseModel):
     id: int
@@ -151,6 +233,10 @@ class QuestType(BaseModel):
 class RewardCreate(BaseModel):
     content: str
 
+# Partial update Reward Schema (Pydantic Model)
+class RewardUpdate(BaseModel):
+    content: Optional[str] = None
+
 # Complete Reward Schema (Pydantic Model)
 class Reward(BaseModel):
     id: int
@@ -167,6 +253,12 @@ class QuestCreate(BaseModel):
     quest_kinds: int
     completed: bool
 
+# Partial update Quest Schema (Pydantic Model)
+class QuestUpdate(BaseModel):
+    content: Optional[int] = None
+    quest_kinds: Optional[int] = None
+    completed: Optional[bool] = None
+
 # Complete Quest Schema (Pydantic Model)
 class Quest(BaseModel):
     id: int
@@ -185,6 +277,11 @@ class ClosenessCreate(BaseModel):
     tree_id: int
     close_meter: int
 
+# Partial update Closeness Schema (Pydantic Model)
+class ClosenessUpdate(BaseModel):
+    tree_id: Optional[int] = None
+    close_meter: Optional[int] = None
+
 # Complete Quest Schema (Pydantic Model)
 class Closeness(BaseModel):
     id: int
@@ -194,6 +291,53 @@ class Closeness(BaseModel):
     class Config:
         orm_mode = True
 
+# Leaderboard entry: a tree and its total close_meter (Pydantic Model)
+class LeaderboardEntry(BaseModel):
+    rank: int
+    tree_id: int
+    close_meter: int
+
+# =================================Dashboard===========================================
+# Tree with the sum of its closeness meters (Pydantic Model)
+class DashboardTree(BaseModel):
+    id: int
+    growth_stage: int
+    quest: int
+    watering: datetime = None
+    close_meter: int
+    closeness_count: int
+
+# QuestType with the number of its quests and of the completed ones (Pydantic Model)
+class DashboardQuestType(BaseModel):
+    id: int
+    kinds: str
+    online: bool
+    quest_count: int
+    completed_count: int
+
+# Dashboard Schema (Pydantic Model)
+class Dashboard(BaseModel):
+    trees: List[DashboardTree]
+    quest_types: List[DashboardQuestType]
+
 
+# =================================Search===========================================
+# Post or comment matching a search (Pydantic Model)
+class SearchHit(BaseModel):
+    kind: str
+    id: int
+    post_id: int
+    user_id: int
+    snippet: str
+    rank: float
+    createdAt: datetime = None
 
 
+# =================================Image===========================================
+# Stored image with the URLs of the original and of its thumbnails, by longest side in pixels (Pydantic Model)
+class ImageUpload(BaseModel):
+    digest: str
+    content_type: str
+    size: int
+    url: str
+    thumbnails: Dict[int, str]
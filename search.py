@@ -0,0 +1,151 @@
+import enum
+import html
+import os
+from fastapi import HTTPException
+from sqlalchemy import Column, Integer, MetaData, String, Table, func, literal, literal_column, select, text, tuple_, union_all
+from pagination import PageParams
+import models
+
+# FTS5 tokenizer of the search tables, fixed when they are created. "trigram" matches any substring
+# of 3 characters or more, which also works for Japanese text written without spaces
+SEARCH_TOKENIZER = os.getenv("KOKOROIKI_SEARCH_TOKENIZER", "trigram")
+# Rows copied per statement when the search tables are filled from existing posts and comments
+SEARCH_BACKFILL_BATCH = int(os.getenv("KOKOROIKI_SEARCH_BACKFILL_BATCH", "5000"))
+
+SNIPPET_START = "<mark>"
+SNIPPET_END = "</mark>"
+SNIPPET_TOKENS = 16
+# What snippet() puts around the matches (private use characters), replaced by SNIPPET_START/END
+# once the stored text around them has been HTML-escaped
+_MARK_START = "\ue000"
+_MARK_END = "\ue001"
+
+# External content FTS5 tables: they index Posts.content / Comments.content and read the text back from them.
+# They are not on Base.metadata (create_all cannot create virtual tables); migrations.py creates them.
+_search_metadata = MetaData()
+posts_search = Table("PostsSearch", _search_metadata, Column("rowid", Integer), Column("content", String))
+comments_search = Table("CommentsSearch", _search_metadata, Column("rowid", Integer), Column("content", String))
+
+SEARCH_TABLES = (
+    (posts_search, models.Post.__table__),
+    (comments_search, models.Comment.__table__),
+)
+
+
+class SearchScope(str, enum.Enum):
+    all = "all"
+    posts = "posts"
+    comments = "comments"
+
+
+# Migration: the search tables, the triggers that keep them in step with every insert, update and delete,
+# and the rows that existed before, copied in batches of SEARCH_BACKFILL_BATCH ids
+def create_search_tables(connection):
+    for search_table, content_table in SEARCH_TABLES:
+        name, content = search_table.name, content_table.name
+        connection.execute(text(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS "{name}" USING fts5('
+            f"content, content='{content}', content_rowid='id', tokenize='{SEARCH_TOKENIZER}')"
+        ))
+        connection.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS "{content}_search_insert" AFTER INSERT ON "{content}" BEGIN '
+            f'INSERT INTO "{name}"(rowid, content) VALUES (new.id, new.content); END'
+        ))
+        connection.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS "{content}_search_delete" AFTER DELETE ON "{content}" BEGIN '
+            f"INSERT INTO \"{name}\"(\"{name}\", rowid, content) VALUES ('delete', old.id, old.content); END"
+        ))
+        connection.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS "{content}_search_update" AFTER UPDATE OF content ON "{content}" BEGIN '
+            f"INSERT INTO \"{name}\"(\"{name}\", rowid, content) VALUES ('delete', old.id, old.content); "
+            f'INSERT INTO "{name}"(rowid, content) VALUES (new.id, new.content); END'
+        ))
+
+        last_id = connection.execute(select(func.max(content_table.c.id))).scalar() or 0
+        for start in range(0, last_id, SEARCH_BACKFILL_BATCH):
+            connection.execute(
+                text(
+                    f'INSERT INTO "{name}"(rowid, content) SELECT id, content FROM "{content}" '
+                    "WHERE id > :start AND id <= :end"
+                ),
+                {"start": start, "end": start + SEARCH_BACKFILL_BATCH},
+            )
+
+
+# The search text as an FTS5 query: every word must appear, each one taken literally (quotes, AND, * ...
+# have no special meaning), so user input can never be an FTS5 syntax error.
+# A trigram index cannot match words of fewer than 3 characters (家族, 木); those are returned apart
+# and checked with instr() on the rows the other words matched
+def match_expression(q: str):
+    words, short = q.split(), []
+    if SEARCH_TOKENIZER == "trigram":
+        short = [word for word in words if len(word) < 3]
+        words = [word for word in words if len(word) >= 3]
+    if not words:
+        raise HTTPException(status_code=400, detail=f"search text {q!r} needs at least one word of 3 characters or more")
+    return " ".join('"' + word.replace('"', '""') + '"' for word in words), short
+
+
+# The snippet as HTML: the post or comment text escaped, only the match markers left as markup
+def _snippet_html(snippet: str):
+    return html.escape(snippet).replace(_MARK_START, SNIPPET_START).replace(_MARK_END, SNIPPET_END)
+
+
+def _hits(kind: str, search_table, model, post_id, match: str, short, family_id: int = None):
+    table = literal_column(f'"{search_table.name}"')
+    query = (
+        select(
+            literal(kind).label("kind"),
+            model.id.label("id"),
+            post_id.label("post_id"),
+            model.user_id.label("user_id"),
+            func.snippet(table, 0, _MARK_START, _MARK_END, "…", SNIPPET_TOKENS).label("snippet"),
+            func.bm25(table).label("rank"),
+            model.createdAt.label("createdAt"),
+        )
+        .select_from(search_table.join(model, model.id == search_table.c.rowid))
+        .where(table.op("MATCH")(match))
+    )
+    for word in short:
+        # case-insensitive like the trigram index (ASCII letters)
+        query = query.where(func.instr(func.lower(model.content), func.lower(word)) > 0)
+    if family_id is not None:
+        # posts written by the family's members, and the comments on those posts
+        author = models.AppUser
+        if model is models.Comment:
+            query = query.join(models.Post, models.Post.id == models.Comment.post_id)
+        query = query.join(author, author.id == models.Post.user_id).where(author.family_id == family_id)
+    return query
+
+
+# One page of posts and/or comments matching q, best BM25 rank first (lower is better in SQLite),
+# each with a snippet of the matching text. The next page starts after the (rank, kind, id) of the last hit
+def search(session, q: str, page: PageParams, scope: SearchScope = SearchScope.all, family_id: int = None):
+    match, short = match_expression(q)
+    selects = []
+    if scope in (SearchScope.all, SearchScope.posts):
+        selects.append(_hits("post", posts_search, models.Post, models.Post.id, match, short, family_id))
+    if scope in (SearchScope.all, SearchScope.comments):
+        selects.append(_hits("comment", comments_search, models.Comment, models.Comment.post_id, match, short, family_id))
+
+    hits = (selects[0] if len(selects) == 1 else union_all(*selects)).subquery("hits")
+    query = select(hits)
+    position = page.position
+    if position is not None:
+        try:
+            after = (float(position["rank"]), str(position["kind"]), position["id"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"invalid cursor {page.after!r}")
+        query = query.where(tuple_(hits.c.rank, hits.c.kind, hits.c.id) > tuple_(*after))
+
+    query = query.order_by(hits.c.rank, hits.c.kind, hits.c.id).limit(page.limit + 1)
+    rows = [dict(row._mapping) for row in session.execute(query)]
+    for row in rows:
+        row["snippet"] = _snippet_html(row["snippet"])
+
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        last = rows[-1]
+        page.set_next(last["id"], rank=last["rank"], kind=last["kind"])
+
+    return rows
@@ -0,0 +1,154 @@
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from fastapi import HTTPException
+
+# scrypt cost factor N (a power of two); memory used per hash is 128 * N * r bytes
+PASSWORD_SCRYPT_N = int(os.getenv("KOKOROIKI_PASSWORD_SCRYPT_N", str(2 ** 14)))
+PASSWORD_SCRYPT_R = int(os.getenv("KOKOROIKI_PASSWORD_SCRYPT_R", "8"))
+PASSWORD_SCRYPT_P = int(os.getenv("KOKOROIKI_PASSWORD_SCRYPT_P", "1"))
+# Worker processes that compute the hashes (0 = hash in the calling thread)
+PASSWORD_HASH_WORKERS = int(os.getenv("KOKOROIKI_PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+# Hash requests allowed in flight at once, and how long a request waits for a slot before a 503
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("KOKOROIKI_PASSWORD_HASH_CONCURRENCY", str(2 * max(PASSWORD_HASH_WORKERS, 1))))
+PASSWORD_HASH_TIMEOUT = float(os.getenv("KOKOROIKI_PASSWORD_HASH_TIMEOUT", "5"))
+# Passwords of a bulk request hashed per slot; each chunk waits for its own slot, so logins keep getting one
+PASSWORD_HASH_CHUNK = int(os.getenv("KOKOROIKI_PASSWORD_HASH_CHUNK", "8"))
+
+_SCHEME = "scrypt"
+_KEY_LENGTH = 32
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_CONCURRENCY)
+
+
+def _b64(data: bytes):
+    return base64.b64encode(data).decode("ascii")
+
+
+# Runs in a worker process: scrypt$N$r$p$salt$key
+def _hash(password: str, n: int = PASSWORD_SCRYPT_N, r: int = PASSWORD_SCRYPT_R, p: int = PASSWORD_SCRYPT_P):
+    salt = secrets.token_bytes(16)
+    key = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=_KEY_LENGTH)
+    return f"{_SCHEME}${n}${r}${p}${_b64(salt)}${_b64(key)}"
+
+
+# Runs in a worker process. Rows written before passwords were hashed hold the plain text; they still verify
+def _verify(password: str, stored: str):
+    if stored is None:
+        return False
+    parts = stored.split("$")
+    if len(parts) != 6 or parts[0] != _SCHEME:
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+
+    n, r, p = (int(value) for value in parts[1:4])
+    salt, key = base64.b64decode(parts[4]), base64.b64decode(parts[5])
+    candidate = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=len(key))
+    return hmac.compare_digest(candidate, key)
+
+
+def _hash_many(passwords):
+    return [_hash(password) for password in passwords]
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # workers come from a forkserver: forking the running server would copy locks held by its other
+            # threads (logging, malloc, SQLite) and could deadlock the child
+            _pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+        return _pool
+
+
+# Holds one of the PASSWORD_HASH_CONCURRENCY slots while hashing.
+# A burst of logins waits here instead of piling up work (and blocked threads) behind the pool
+def _acquire():
+    if not _slots.acquire(timeout=PASSWORD_HASH_TIMEOUT):
+        raise HTTPException(status_code=503, detail="too many password requests, try again later")
+
+
+@contextmanager
+def _slot():
+    _acquire()
+    try:
+        yield
+    finally:
+        _slots.release()
+
+
+def _run(fn, *args):
+    with _slot():
+        if PASSWORD_HASH_WORKERS <= 0:
+            return fn(*args)
+        return _executor().submit(fn, *args).result()
+
+
+def hash_password(password: str):
+    return _run(_hash, password)
+
+
+# Submits fn to the pool under a slot that is released when it finishes (or is cancelled)
+def _submit(fn, *args):
+    _acquire()
+    try:
+        future = _executor().submit(fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+# Hashes of several passwords (bulk create), PASSWORD_HASH_CHUNK at a time, one slot per chunk,
+# so a large batch is spread over the workers without holding the pool away from logins
+def hash_passwords(passwords):
+    passwords = list(passwords)
+    chunks = [passwords[start:start + PASSWORD_HASH_CHUNK] for start in range(0, len(passwords), PASSWORD_HASH_CHUNK)]
+    if PASSWORD_HASH_WORKERS <= 0:
+        return [hashed for chunk in chunks for hashed in _run(_hash_many, chunk)]
+
+    futures = []
+    try:
+        for chunk in chunks:
+            futures.append(_submit(_hash_many, chunk))
+        return [hashed for future in futures for hashed in future.result()]
+    finally:
+        # a chunk that could not get a slot fails the request, don't hash the ones still queued
+        for future in futures:
+            future.cancel()
+
+
+def verify_password(password: str, stored: str):
+    return _run(_verify, password, stored)
+
+
+# True when the stored value is plain text or was hashed with other cost parameters than the current ones
+def needs_rehash(stored: str):
+    return stored is None or not stored.startswith(f"{_SCHEME}${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}$")
+
+
+# Verified against when the email is unknown, so both failures take as long
+_DUMMY_HASH = None
+
+
+def dummy_hash():
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = hash_password(secrets.token_urlsafe(16))
+    return _DUMMY_HASH
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
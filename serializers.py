@@ -0,0 +1,71 @@
+import json
+import os
+import typing
+from datetime import date, datetime
+from functools import lru_cache
+from operator import attrgetter
+from fastapi.responses import JSONResponse
+from sqlalchemy import inspect
+from loaders import nested_schema
+
+try:
+    import orjson
+except ImportError:  # the fast path still works without orjson, with the stdlib encoder
+    orjson = None
+
+# Opt-in: serialize list/detail responses with precompiled serializers instead of response_model validation
+FAST_JSON = os.getenv("KOKOROIKI_FAST_JSON", "0") == "1"
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+# JSON response rendered with orjson when it is installed
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content)
+        return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# Build, once per (model, schema), a function that turns a row into the dict response_model would produce.
+# Fields keep the schema's order; nested schemas get their own compiled serializer.
+@lru_cache(maxsize=None)
+def serializer(model, schema):
+    mapper = inspect(model)
+    names = []
+    nested = []
+    for name, annotation in typing.get_type_hints(schema).items():
+        child = nested_schema(annotation)
+        if child is not None and name in mapper.relationships:
+            relationship = mapper.relationships[name]
+            names.append(name)
+            nested.append((name, serializer(relationship.mapper.class_, child), relationship.uselist))
+        elif name in mapper.columns:
+            names.append(name)
+
+    get_values = attrgetter(*names)
+    single = len(names) == 1
+
+    def serialize(row):
+        if row is None:
+            return None
+        values = get_values(row)
+        data = dict(zip(names, (values,) if single else values))
+        for name, serialize_child, uselist in nested:
+            value = data[name]
+            data[name] = [serialize_child(item) for item in value] if uselist else serialize_child(value)
+        return data
+
+    return serialize
+
+
+# Rows (or a single row) as a response, without the validate-then-jsonable_encoder round trip
+def fast_response(model, schema, result):
+    serialize = serializer(model, schema)
+    if isinstance(result, list):
+        return FastJSONResponse([serialize(row) for row in result])
+    return FastJSONResponse(serialize(result))
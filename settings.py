@@ -0,0 +1,38 @@
+from typing import Literal
+from pydantic import BaseSettings, validator
+from sqlalchemy.engine import make_url
+from database import SQLITE_PROFILES, in_memory
+
+
+# Database settings of an app (main.create_app), read from the KOKOROIKI_* environment unless given.
+# The tuning knobs of the other modules are still read from the environment where they are used
+class Settings(BaseSettings):
+    database_url: str = "sqlite:///kokoroiki.db"
+    # "sync" (default): read routes run their queries in Starlette's threadpool
+    # "async": read routes run them on an AsyncSession (aiosqlite) without holding a worker thread
+    db_mode: Literal["sync", "async"] = "sync"
+    # PRAGMAs run on every new SQLite connection, one of database.SQLITE_PROFILES
+    sqlite_profile: str = "production"
+    # Connections kept open per process. With WAL every pooled connection can read while another one writes.
+    pool_size: int = 10
+    max_overflow: int = 20
+    pool_timeout: float = 30
+    # Create the tables and apply the migrations at startup (tests, a throwaway database).
+    # Otherwise the schema is managed with `python migrations.py` and startup only checks its version
+    create_schema: bool = False
+
+    # The async engine opens its own connection, which would be a second, empty in-memory database
+    @validator("db_mode")
+    def file_for_async(cls, value, values):
+        if value == "async" and "database_url" in values and in_memory(make_url(values["database_url"])):
+            raise ValueError("async mode needs a database file, an in-memory database is only seen by the sync engine")
+        return value
+
+    @validator("sqlite_profile")
+    def known_profile(cls, value):
+        if value not in SQLITE_PROFILES:
+            raise ValueError(f"must be one of {sorted(SQLITE_PROFILES)}, not {value!r}")
+        return value
+
+    class Config:
+        env_prefix = "KOKOROIKI_"
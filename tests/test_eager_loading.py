@@ -0,0 +1,61 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+import main
+import models
+from settings import Settings
+
+# The list routes load their nested relationships (Post.user.family, AppUser.family, Quest.quests) with
+# a fixed number of queries, whatever the number of rows: no lazy load per row.
+
+ROUTES = ["/posts", "/quests", "/app-users"]
+
+
+# Every row points to a different parent, so a lazy load per row would show up as n more queries
+def seed(app, n: int):
+    with app.state.database.sessions() as session:
+        for i in range(1, n + 1):
+            session.add(models.Family(id=i, name=f"family{i}"))
+            session.add(models.AppUser(
+                id=i, name=f"user{i}", email=f"user{i}@example.com", birth=2000, age=20,
+                gender="f", quest_role=False, family_id=i,
+            ))
+            session.add(models.Post(id=i, user_id=i, kids=1, content=f"post {i}", image_url="", like=0))
+            session.add(models.QuestType(id=i, kinds=f"kind{i}", online=False))
+            session.add(models.Quest(id=i, content=i, quest_kinds=i, completed=False))
+        session.commit()
+
+
+# Statements each route sends to the database for one page of `n` rows, on an app with its own in-memory database
+def count_queries(n: int):
+    app = main.create_app(Settings(database_url="sqlite://", create_schema=True))
+    counts = {}
+    with TestClient(app) as client:
+        seed(app, n)
+        engine = app.state.database.engine
+        for route in ROUTES:
+            statements = []
+
+            def count(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            event.listen(engine, "before_cursor_execute", count)
+            try:
+                response = client.get(route, params={"limit": 50})
+            finally:
+                event.remove(engine, "before_cursor_execute", count)
+            assert response.status_code == 200
+            assert len(response.json()) == n
+            counts[route] = len(statements)
+    return counts
+
+
+@pytest.fixture(scope="module")
+def query_counts():
+    return count_queries(2), count_queries(20)
+
+
+@pytest.mark.parametrize("route", ROUTES)
+def test_queries_do_not_grow_with_rows(query_counts, route):
+    few, many = query_counts
+    assert few[route] == many[route]
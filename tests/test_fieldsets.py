@@ -0,0 +1,42 @@
+import pytest
+from fastapi.testclient import TestClient
+import fieldsets
+import main
+import models
+from settings import Settings
+
+# A sparse fieldset (?fields= / ?expand=) is rendered by FieldSelection itself, which must keep the headers
+# the route set on its Response: the next page's Link and X-Next-Cursor.
+
+
+@pytest.fixture(params=[False, True], ids=["json", "fast-json"])
+def client(request, monkeypatch):
+    monkeypatch.setattr(fieldsets, "FAST_JSON", request.param)
+    app = main.create_app(Settings(database_url="sqlite://", create_schema=True))
+    with TestClient(app) as client:
+        with app.state.database.sessions() as session:
+            session.add(models.Family(id=1, name="family"))
+            for id, name in enumerate(("first", "second"), start=1):
+                session.add(models.AppUser(
+                    id=id, name=name, email=f"{name}@example.com", birth=2000, age=20,
+                    gender="f", quest_role=False, family_id=1,
+                ))
+            session.commit()
+        yield client
+
+
+@pytest.mark.parametrize("params", [{}, {"fields": "name"}, {"expand": "family"}], ids=["full", "fields", "expand"])
+def test_next_page_headers_are_kept(client, params):
+    response = client.get("/app-users", params={"limit": 1, **params})
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    assert 'rel="next"' in response.headers["Link"]
+    assert response.headers["X-Next-Cursor"]
+
+
+def test_sparse_page_follows_link(client):
+    first = client.get("/app-users", params={"limit": 1, "fields": "name"})
+    after = first.headers["X-Next-Cursor"]
+    second = client.get("/app-users", params={"limit": 1, "fields": "name", "after": after})
+    assert [user["name"] for user in first.json()] == ["first"]
+    assert [user["name"] for user in second.json()] == ["second"]
@@ -0,0 +1,103 @@
+import os
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import func, inspect, insert, update
+from loaders import eager_options
+import models
+
+# Most rows a single bulk request may create
+BULK_MAX_ROWS = int(os.getenv("KOKOROIKI_BULK_MAX_ROWS", "10000"))
+# Rows sent per multi-row INSERT ... RETURNING statement
+BULK_BATCH_SIZE = int(os.getenv("KOKOROIKI_BULK_BATCH_SIZE", "1000"))
+
+# Columns the create routes stamp with the current time
+CREATED_TIMESTAMPS = ("last_login", "createdAt", "updatedAt", "publishedAt", "watering")
+
+
+# Column values for a new row of `model` from a *Create schema, as the single-row create routes build them
+def insert_values(model, data: dict, now: datetime):
+    columns = inspect(model).columns.keys()
+    values = {name: value for name, value in data.items() if name in columns}
+    for name in CREATED_TIMESTAMPS:
+        if name in columns:
+            values[name] = now
+    return values
+
+
+# Insert one row with INSERT ... RETURNING: the new row comes back from the same statement, no refresh SELECT
+def create_row(session, model, item):
+    statement = insert(model).values(**insert_values(model, item.dict(), datetime.today())).returning(model)
+    row = session.scalars(statement).one()
+    session.commit()
+
+    return row
+
+
+# Update one row with UPDATE ... WHERE id = :id RETURNING, without loading it first.
+# Only the given columns are written (plus updatedAt where the table has it).
+# Returns the updated row, or None when no row has that id
+def update_row(session, model, id: int, data: dict):
+    columns = inspect(model).columns.keys()
+    values = {name: value for name, value in data.items() if name in columns and name != "id"}
+    if "updatedAt" in columns:
+        values["updatedAt"] = datetime.today()
+
+    # nothing to write (empty PATCH on a table without updatedAt)
+    if not values:
+        return session.get(model, id)
+
+    statement = update(model).where(model.id == id).values(**values).returning(model)
+    row = session.scalars(statement).first()
+    session.commit()
+
+    return row
+
+
+# 413 for a bulk request over BULK_MAX_ROWS; call it before any per-item work (e.g. password hashing)
+def check_bulk_size(items):
+    if len(items) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"at most {BULK_MAX_ROWS} items can be created per request")
+
+
+# Insert every item in one transaction, BULK_BATCH_SIZE rows per statement.
+# RETURNING hands back the new rows, so no per-row refresh SELECT is needed;
+# relationships nested in the response schema are then loaded with one query per batch.
+def bulk_insert(session, model, schema, items):
+    check_bulk_size(items)
+
+    now = datetime.today()
+    rows = [insert_values(model, item.dict(), now) for item in items]
+    options = eager_options(model, schema)
+
+    created = []
+    # sort_by_parameter_order: the response lists the rows in the order the items were sent
+    for start in range(0, len(rows), BULK_BATCH_SIZE):
+        batch = session.scalars(insert(model).returning(model, sort_by_parameter_order=True), rows[start:start + BULK_BATCH_SIZE]).all()
+        if options:
+            session.query(model).options(*options).filter(model.id.in_([row.id for row in batch])).all()
+        created.extend(batch)
+
+    session.commit()
+
+    return created
+
+
+# New value of Posts.like after adding `delta` (never below zero, NULL counts as zero)
+def like_after(delta):
+    return func.max(func.coalesce(models.Post.like, 0) + delta, 0)
+
+
+# Add n likes (negative to remove) with a single UPDATE ... RETURNING, so concurrent likes can't overwrite each other.
+# Returns the new count, or None if the post does not exist
+def increment_like(session, post_id: int, n: int):
+    statement = (
+        update(models.Post)
+        .where(models.Post.id == post_id)
+        .values(like=like_after(n), updatedAt=datetime.today())
+        .returning(models.Post.like)
+        .execution_options(synchronize_session=False)
+    )
+    like = session.execute(statement).scalar()
+    session.commit()
+
+    return like